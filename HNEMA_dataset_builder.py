@@ -0,0 +1,512 @@
+# build the model training files (data4training_model) from the compiled files (original_compiled_data)
+# this is the command-line version of dataset_processing_demo_HNEMA.ipynb, it produces the same files, but every
+# interaction matrix is built as a scipy sparse matrix and the samples are selected by pandas joins instead of iterrows,
+# so the heterogeneous network is never materialized as a dense (dim x dim) matrix
+# example: python HNEMA_dataset_builder.py --source-prefix ./data/original_compiled_data/ --output-prefix ./data/data4training_model/ --ppi-fix
+import argparse
+import pathlib
+import pickle
+import shutil
+import numpy as np
+import pandas as pd
+import scipy.sparse
+
+# the order of the TE labels in train_val_test_drug_drug_labels.npz
+te_label_columns = ['S_mean', 'synergy_zip', 'synergy_loewe', 'synergy_hsa', 'synergy_bliss']
+# the metapaths generated for the drugs (0-se-0 is generated as in the notebook, but it is not used by HNEMA)
+involved_metapaths = [(0, 1, 0), (0, 1, 1, 0), (0, 1, 1, 1, 0), (0, 'te', 0), (0, 'se', 0)]
+
+
+def read_compiled_data(source_prefix, ppi_fix=False):
+    # chemical feature information of involved drugs (including ECFP and molecular graphs)
+    in_file = open(source_prefix + 'drugcomb_alldruginfo_dict.pickle', 'rb')
+    drugcomb_alldruginfo_dict = pickle.load(in_file)
+    in_file.close()
+
+    drugcomb = pd.read_csv(source_prefix + 'drugcomb.csv')
+    twosides = pd.read_csv(source_prefix + 'twosides.csv')
+    drug_target = pd.read_csv(source_prefix + 'drug_target_inter.csv')
+    target_target = pd.read_csv(source_prefix + 'target_target_inter.csv')
+
+    drugcomb = drugcomb.rename(columns={'drug_row': 'drug1', 'drug_col': 'drug2'})
+    twosides = twosides[['drug1', 'drug2', 'Polypharmacy Side Effect', 'Side Effect Name', 'drug1_lower', 'drug2_lower', 'unified_name']]
+    # the synergy_loewe of 4 samples is '\N', these samples are removed
+    drugcomb = drugcomb[drugcomb['synergy_loewe'].astype(str) != '\\N']
+    for synergy_score in ['synergy_zip', 'synergy_hsa', 'synergy_bliss', 'synergy_loewe']:
+        drugcomb[synergy_score] = drugcomb[synergy_score].astype('float')
+    drugcomb = drugcomb.reset_index(drop=True)
+
+    drug_target = drug_target.rename(columns={'target': 'gene symbol'})[['drug', 'drug_lower', 'gene symbol']]
+    target_target = target_target[['gene1 symbol', 'gene2 symbol']].copy()
+    # the wrong gene symbol of one sample in the compiled PPI file (only for the original target_target_inter.csv,
+    # so it is opt-in: the same row of any other PPI file is a valid interaction and must not be overwritten)
+    if ppi_fix:
+        if len(target_target) <= 103608:
+            raise ValueError('ppi_fix is only for the original target_target_inter.csv, the PPI file has {} rows'.format(
+                len(target_target)))
+        print('ppi_fix: gene1 symbol of the PPI row 103608 is replaced:', target_target.iloc[103608, 0], '-> WTIP')
+        target_target.iloc[103608, 0] = 'WTIP'
+
+    return drugcomb_alldruginfo_dict, drugcomb, twosides, drug_target, target_target
+
+
+def select_samples(drugcomb, twosides, num_cellline=20):
+    # keep the drug pairs included by both drugcomb and twosides
+    inter_pair_set = set(twosides['unified_name']) & set(drugcomb['unified_name'])
+    drugcomb = drugcomb[drugcomb['unified_name'].isin(inter_pair_set)]
+
+    # keep the samples of the num_cellline cell lines with the most samples
+    # (counted in the sorted order of the cell line names, and ranked by the same sort as in the notebook)
+    cellline_num_list = drugcomb['cell_line_name'].value_counts().sort_index()
+    cellline_num_list = pd.DataFrame({0: cellline_num_list.index, 1: cellline_num_list.values})
+    cellline_num_list = cellline_num_list.sort_values([1], ascending=False).reset_index(drop=True)
+    cellline_rank = {cellline: i for i, cellline in enumerate(cellline_num_list[0][:num_cellline])}
+    drugcomb_sorted = drugcomb[drugcomb['cell_line_name'].isin(cellline_rank)]
+    # the samples are grouped by the cell line rank (stable, so the original order is kept in every cell line)
+    drugcomb_sorted = drugcomb_sorted.iloc[
+        np.argsort(drugcomb_sorted['cell_line_name'].map(cellline_rank).to_numpy(), kind='stable')].reset_index(drop=True)
+
+    twosides_sorted = twosides[twosides['unified_name'].isin(set(drugcomb_sorted['unified_name']))].reset_index(drop=True)
+    return drugcomb_sorted, twosides_sorted
+
+
+def build_id_dicts(drugcomb_sorted, drug_target, target_target):
+    # the order of the drugs and targets is fixed by sorting their names
+    drugset = sorted(set(drugcomb_sorted['drug1_lower']) | set(drugcomb_sorted['drug2_lower']))
+    drug2id_dict = {drug: i for i, drug in enumerate(drugset)}
+
+    drug_target_sorted = drug_target[drug_target['drug_lower'].isin(drug2id_dict)].reset_index(drop=True)
+    # the PPIs with at least one target of the involved drugs
+    targetset = set(drug_target_sorted['gene symbol'])
+    target_target_sorted = target_target[target_target['gene1 symbol'].isin(targetset) |
+                                         target_target['gene2 symbol'].isin(targetset)].reset_index(drop=True)
+    targetset = sorted(targetset | set(target_target_sorted['gene1 symbol']) | set(target_target_sorted['gene2 symbol']))
+    target2id_dict = {target: i for i, target in enumerate(targetset)}
+
+    cellline2id_dict = {cellline: i for i, cellline in enumerate(sorted(set(drugcomb_sorted['cell_line_name'])))}
+
+    drugcomb_sorted = drugcomb_sorted.assign(drugid1=drugcomb_sorted['drug1_lower'].map(drug2id_dict),
+                                             drugid2=drugcomb_sorted['drug2_lower'].map(drug2id_dict))
+    drug_target_sorted = drug_target_sorted.assign(drugid=drug_target_sorted['drug_lower'].map(drug2id_dict),
+                                                   targetid=drug_target_sorted['gene symbol'].map(target2id_dict))
+    target_target_sorted = target_target_sorted.assign(targetid1=target_target_sorted['gene1 symbol'].map(target2id_dict),
+                                                       targetid2=target_target_sorted['gene2 symbol'].map(target2id_dict))
+    return drug2id_dict, target2id_dict, cellline2id_dict, drugcomb_sorted, drug_target_sorted, target_target_sorted
+
+
+def qualified_te_pairs(drugcomb_sorted, used_synergy_score='synergy_loewe', z_threshold=1.64):
+    # the (ordered) drug pairs with a synergy score z-score >= z_threshold (PPF of the standard normal distribution for 0.95)
+    synergy_score = drugcomb_sorted[used_synergy_score].to_numpy(dtype=float)
+    z_score = (synergy_score - np.mean(synergy_score)) / np.std(synergy_score)
+    qualified = drugcomb_sorted[z_score >= z_threshold]
+    return set(zip(qualified['drugid1'], qualified['drugid2']))
+
+
+def split_drug_pairs(drugcomb_sorted, twosides_sorted, random_seed=1012, folds=10, val_fold=8, test_fold=9):
+    # split the drug pairs (not the drug-drug-cell line samples) into training, validation and test sets
+    inter_pair_set = sorted(set(twosides_sorted['unified_name']) & set(drugcomb_sorted['unified_name']))
+    prng = np.random.RandomState(random_seed)
+    allindex = prng.permutation(len(inter_pair_set))
+    pos_inter_fold = np.array_split(allindex, folds)
+    val_idx = np.sort(pos_inter_fold[val_fold])
+    test_idx = np.sort(pos_inter_fold[test_fold])
+    train_idx = np.sort(np.concatenate([fold for i, fold in enumerate(pos_inter_fold) if i not in [val_fold, test_fold]]))
+    inter_pair_set = np.array(inter_pair_set)
+    return inter_pair_set[train_idx], inter_pair_set[val_idx], inter_pair_set[test_idx]
+
+
+def symmetric_pairs(pairs):
+    # the sorted unique (drug1, drug2) pairs of both directions
+    pairs = np.asarray(pairs, dtype=np.int64).reshape(-1, 2)
+    return np.unique(np.concatenate([pairs, pairs[:, [1, 0]]], axis=0), axis=0)
+
+
+def build_adjacency(num_drug, num_target, num_cellline, drug_target_sorted, target_target_sorted, train_drug_pairs):
+    # the heterogeneous adjacency matrix (drug-target, target-target and the drug pairs of the training set), symmetric
+    # node order: drugs, targets, cell lines (the cell lines have no edges)
+    dim = num_drug + num_target + num_cellline
+    rows = np.concatenate([drug_target_sorted['drugid'].to_numpy(dtype=np.int64),
+                           num_drug + target_target_sorted['targetid1'].to_numpy(dtype=np.int64),
+                           train_drug_pairs[:, 0]])
+    cols = np.concatenate([num_drug + drug_target_sorted['targetid'].to_numpy(dtype=np.int64),
+                           num_drug + target_target_sorted['targetid2'].to_numpy(dtype=np.int64),
+                           train_drug_pairs[:, 1]])
+    rows, cols = np.concatenate([rows, cols]), np.concatenate([cols, rows])
+    adjM = scipy.sparse.coo_matrix((np.ones(len(rows), dtype=np.int64), (rows, cols)), shape=(dim, dim)).tocsr()
+    # the duplicated edges are summed by tocsr, every edge is stored as 1
+    adjM.sort_indices()
+    adjM.data[:] = 1
+
+    type_mask = np.zeros(dim, dtype=int)
+    type_mask[num_drug:num_drug + num_target] = 1
+    type_mask[num_drug + num_target:] = 2
+    return adjM, type_mask
+
+
+def csr_rows(matrix):
+    # the column indices of every row of a csr matrix (the same as matrix[i].nonzero()[1])
+    matrix = scipy.sparse.csr_matrix(matrix)
+    matrix.sort_indices()
+    return [matrix.indices[matrix.indptr[i]:matrix.indptr[i + 1]] for i in range(matrix.shape[0])]
+
+
+def stack_instances(instance_list, metapath_len):
+    if len(instance_list) == 0:
+        return np.zeros((0, metapath_len), dtype=np.int64)
+    return np.concatenate(instance_list).astype(np.int64)
+
+
+def metapath_sort(instances):
+    # order the instances by (first node, last node, intermediate nodes)
+    metapath_len = instances.shape[1]
+    sort_order = [0, metapath_len - 1] + list(range(1, metapath_len - 1))
+    return instances[np.lexsort(instances[:, sort_order].T[::-1])]
+
+
+def expand_paths(paths, matrix, keep=None):
+    # CSR join: extend every path by all neighbors of its last node in matrix
+    # (the paths are repeated by the degrees of their last nodes and the neighbors are gathered from the indices)
+    # keep: optional boolean mask of the new nodes, the paths to the other nodes are dropped
+    last = paths[:, -1]
+    starts = matrix.indptr[last]
+    degrees = matrix.indptr[last + 1] - starts
+    path_idx = np.repeat(np.arange(len(paths)), degrees)
+    neighbor_pos = np.arange(len(path_idx)) - np.repeat(np.cumsum(degrees) - degrees, degrees) + starts[path_idx]
+    paths = np.column_stack([paths[path_idx], matrix.indices[neighbor_pos]])
+    if keep is not None:
+        paths = paths[keep[paths[:, -1]]]
+    return paths
+
+
+def write_metapath_instances(path, steps, counts, target_columns, num_drug, max_chunk_instances=1 << 22):
+    # enumerate the instances of one metapath starting from every drug and write them to a .npy file chunk by chunk
+    # steps: the (csr matrix, keep mask) of every hop, counts: number of instances of every first drug
+    # the chunks are consecutive ranges of first drugs, so sorting every chunk gives the global order
+    offsets = np.zeros(num_drug + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    instances = np.lib.format.open_memmap(path, mode='w+', dtype=np.int32, shape=(int(offsets[-1]), len(steps) + 1))
+    start = 0
+    while start < num_drug:
+        end = max(start + 1, int(np.searchsorted(offsets, offsets[start] + max_chunk_instances, side='right')) - 1)
+        end = min(end, num_drug)
+        paths = np.arange(start, end, dtype=np.int64)[:, None]
+        for matrix, keep in steps:
+            paths = expand_paths(paths, matrix, keep)
+        assert len(paths) == offsets[end] - offsets[start], 'the number of the instances of {} does not match'.format(path)
+        paths[:, target_columns] += num_drug
+        instances[offsets[start]:offsets[end]] = metapath_sort(paths)
+        start = end
+    instances.flush()
+    del instances
+    return np.load(path, mmap_mode='r')
+
+
+def sample_drug_target_target_target_drug(target_drug, target_target, num_drug, dtttd_ratio, random_seed):
+    # the notebook version of the drug-target-target-target-drug (0-1-1-1-0) metapath: the drugs of the two ends of
+    # every target-target-target (1-1-1) path are sampled by dtttd_ratio (with the same random number sequence)
+    target_drug_list = csr_rows(target_drug)
+    target_target_list = csr_rows(target_target)
+    # target-target-target ordered by (target1, target2, target)
+    target_target_target = [np.stack(np.meshgrid(target_list, [target], target_list, indexing='ij'), -1).reshape(-1, 3)
+                            for target, target_list in enumerate(target_target_list)]
+    target_target_target = metapath_sort(stack_instances(target_target_target, 3))
+    prng = np.random.RandomState(random_seed)
+    drug_target_target_target_drug = []
+    for target1, target, target2 in target_target_target:
+        if len(target_drug_list[target1]) == 0 or len(target_drug_list[target]) == 0:
+            continue
+        candidate_drug1_list = target_drug_list[target1][
+            prng.choice(len(target_drug_list[target1]), int(dtttd_ratio * len(target_drug_list[target1])), replace=False)]
+        candidate_drug2_list = target_drug_list[target2][
+            prng.choice(len(target_drug_list[target2]), int(dtttd_ratio * len(target_drug_list[target2])), replace=False)]
+        drug_target_target_target_drug.append(
+            np.stack(np.meshgrid(candidate_drug1_list, [target1], [target], [target2], candidate_drug2_list, indexing='ij'),
+                     -1).reshape(-1, 5))
+    drug_target_target_target_drug = stack_instances(drug_target_target_target_drug, 5)
+    drug_target_target_target_drug[:, [1, 2, 3]] += num_drug
+    return metapath_sort(drug_target_target_target_drug)
+
+
+def enumerate_metapaths(adjM, num_drug, num_target, te_pairs, se_pairs, instance_prefix, dtttd_ratio=0.3,
+                        random_seed=1012, max_chunk_instances=1 << 22):
+    # the metapath instances (absolute indices) ordered by (first node, last node, intermediate nodes)
+    # the instances of the drug-target metapaths are written to instance_prefix + <metapath>.npy and memory-mapped
+    pathlib.Path(instance_prefix).mkdir(parents=True, exist_ok=True)
+    target_block = slice(num_drug, num_drug + num_target)
+    drug_target = scipy.sparse.csr_matrix(adjM[:num_drug, target_block], dtype=np.int64)
+    target_target = scipy.sparse.csr_matrix(adjM[target_block, target_block], dtype=np.int64)
+    target_drug = scipy.sparse.csr_matrix(adjM[target_block, :num_drug], dtype=np.int64)
+    for matrix in [drug_target, target_target, target_drug]:
+        matrix.sort_indices()
+
+    # number of the instances starting from every drug (the number of paths is given by the products of the adjacencies)
+    target_degrees = np.diff(target_drug.indptr)
+    # in the notebook, the middle target of drug-target-target-target-drug has to be connected to a drug as well
+    middle_keep = target_degrees > 0
+    paths_tt0 = target_target @ target_degrees
+    paths_ttt0 = target_target @ (middle_keep * paths_tt0)
+    counts_010 = drug_target @ target_degrees
+    counts_0110 = drug_target @ paths_tt0
+    counts_01110 = drug_target @ paths_ttt0
+    # the paths that cannot be completed to a drug are dropped at every hop (keep masks), not only by the last hop,
+    # so every intermediate path of a chunk leads to at least one instance and no hop grows beyond the chunk size
+    keep_0110 = [paths_tt0 > 0, target_degrees > 0, None]
+    keep_01110 = [paths_ttt0 > 0, middle_keep & (paths_tt0 > 0), target_degrees > 0, None]
+
+    metapath_indices_mapping = {}
+    # drug-target-drug (0-1-0)
+    metapath_indices_mapping[(0, 1, 0)] = write_metapath_instances(
+        instance_prefix + '0-1-0.npy', [(drug_target, None), (target_drug, None)], counts_010, [1], num_drug,
+        max_chunk_instances)
+    # drug-target-target-drug (0-1-1-0), based on both directions of the target-target interactions
+    metapath_indices_mapping[(0, 1, 1, 0)] = write_metapath_instances(
+        instance_prefix + '0-1-1-0.npy', list(zip([drug_target, target_target, target_drug], keep_0110)),
+        counts_0110, [1, 2], num_drug, max_chunk_instances)
+    # drug-target-target-target-drug (0-1-1-1-0)
+    if dtttd_ratio >= 1:
+        metapath_indices_mapping[(0, 1, 1, 1, 0)] = write_metapath_instances(
+            instance_prefix + '0-1-1-1-0.npy',
+            list(zip([drug_target, target_target, target_target, target_drug], keep_01110)),
+            counts_01110, [1, 2, 3], num_drug, max_chunk_instances)
+    else:
+        # this sampling ratio could be further adjusted according to the computational resources you have
+        np.save(instance_prefix + '0-1-1-1-0.npy', sample_drug_target_target_target_drug(
+            target_drug, target_target, num_drug, dtttd_ratio, random_seed).astype(np.int32))
+        metapath_indices_mapping[(0, 1, 1, 1, 0)] = np.load(instance_prefix + '0-1-1-1-0.npy', mmap_mode='r')
+
+    # drug-te-drug (0-te-0) and drug-se-drug (0-se-0) from the drug pairs of the training set (both directions)
+    metapath_indices_mapping[(0, 'te', 0)] = symmetric_pairs(te_pairs)
+    metapath_indices_mapping[(0, 'se', 0)] = symmetric_pairs(se_pairs)
+    return metapath_indices_mapping
+
+
+class streamed_dict:
+    # pickled as a plain dict whose items are produced by a generator while it is written,
+    # so the (large) dict of the _idx.pickle files is never kept in memory
+    def __init__(self, items):
+        self.items = items
+
+    def __reduce__(self):
+        return dict, (), None, None, self.items
+
+
+def metapath_offsets(edge_metapath_idx_array, num_drug, max_chunk_instances=1 << 22):
+    # the instances of drug i are in [offsets[i], offsets[i + 1]) (the instances are ordered by the first node),
+    # counted chunk by chunk so that the first column of a memory-mapped array is never read as a whole
+    counts = np.zeros(num_drug, dtype=np.int64)
+    for start in range(0, len(edge_metapath_idx_array), max_chunk_instances):
+        counts += np.bincount(edge_metapath_idx_array[start:start + max_chunk_instances, 0], minlength=num_drug)
+    offsets = np.zeros(num_drug + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    return offsets
+
+
+def export_metapaths(output_prefix, metapath_indices_mapping, num_drug, max_chunk_instances=1 << 22):
+    # write the .adjlist (metapath neighbors, relative index) and _idx.pickle (metapath instances with the central node
+    # in the last position, absolute index) files of every metapath of the drugs, together with the binary MetapathCSR
+    # files (<metapath>_offsets/_neighbors/_instances.npy) read by --csr-store
+    # the sorted instances are read in chunks of consecutive drugs, so a memory-mapped instance array is never loaded
+    pathlib.Path(output_prefix + '0').mkdir(parents=True, exist_ok=True)
+    for metapath, edge_metapath_idx_array in metapath_indices_mapping.items():
+        metapath_name = '-'.join(map(str, metapath))
+        path_prefix = output_prefix + '0/' + metapath_name
+        offsets = metapath_offsets(edge_metapath_idx_array, num_drug, max_chunk_instances)
+        num_instances, metapath_len = int(offsets[-1]), edge_metapath_idx_array.shape[1]
+        assert num_instances == len(edge_metapath_idx_array), 'the instances of {} are not ordered by the first node'.format(metapath_name)
+
+        np.save(path_prefix + '_offsets.npy', offsets)
+        neighbors_csr = np.lib.format.open_memmap(path_prefix + '_neighbors.npy', mode='w+', dtype=np.int32,
+                                                  shape=(num_instances,))
+        instances_csr = np.lib.format.open_memmap(path_prefix + '_instances.npy', mode='w+', dtype=np.int32,
+                                                  shape=(num_instances, metapath_len))
+        adjlist_file = open(path_prefix + '.adjlist', 'w')
+
+        def metapath_items():
+            # the .adjlist lines and the CSR rows are written while the items of the _idx.pickle dict are generated
+            start = 0
+            while start < num_drug:
+                end = max(start + 1, int(np.searchsorted(offsets, offsets[start] + max_chunk_instances, side='right')) - 1)
+                end = min(end, num_drug)
+                # in GNN, the last node of a metapath instance is the central (target) node, so the instances are reversed
+                chunk = np.asarray(edge_metapath_idx_array[offsets[start]:offsets[end]], dtype=np.int64)[:, ::-1]
+                chunk_offsets = offsets[start:end + 1] - offsets[start]
+                # the metapath neighbors (the first node of the reversed instances), relative index of the drugs
+                neighbors_csr[offsets[start]:offsets[end]] = chunk[:, 0]
+                instances_csr[offsets[start]:offsets[end]] = chunk
+                adjlist_file.write(''.join(
+                    ' '.join(map(str, [target_idx] + chunk[chunk_offsets[i]:chunk_offsets[i + 1], 0].tolist())) + '\n'
+                    for i, target_idx in enumerate(range(start, end))))
+                for i, target_idx in enumerate(range(start, end)):
+                    yield target_idx, np.ascontiguousarray(chunk[chunk_offsets[i]:chunk_offsets[i + 1]])
+                start = end
+
+        with open(path_prefix + '_idx.pickle', 'wb') as out_file:
+            pickler = pickle.Pickler(out_file)
+            # no memo, otherwise every pickled array is kept alive until the end
+            pickler.fast = True
+            pickler.dump(streamed_dict(metapath_items()))
+        adjlist_file.close()
+        neighbors_csr.flush()
+        instances_csr.flush()
+        del neighbors_csr, instances_csr
+
+
+def build_drug_graphs(output_prefix, drugcomb_alldruginfo_dict, drug2id_dict):
+    # molecular graphs (for the variant HNE-GIN) and ECFP6 of every drug in the order of the drug ids
+    drugcomb_alldruginfo_dict_lower = {key.lower(): value for key, value in drugcomb_alldruginfo_dict.items()}
+    drug_graph_edges, drug_graph_properties, drug_graph_nodes, ECFP6_DNN = [], [], [], []
+    for drug, drugid in sorted(drug2id_dict.items(), key=lambda item: item[1]):
+        druginfo = drugcomb_alldruginfo_dict_lower[drug]
+        ECFP6_DNN.append(druginfo['morgan_bit'])
+        num_nodes = druginfo['adjacent_matrix'].shape[0]
+        src, dst = np.nonzero(druginfo['adjacent_matrix'])
+        # the bonds followed by the self loops
+        src = np.concatenate([src, np.arange(num_nodes)])
+        dst = np.concatenate([dst, np.arange(num_nodes)])
+        drug_graph_edges.append(pd.DataFrame({'graph_id': drugid, 'src': src, 'dst': dst}))
+        drug_graph_properties.append([drugid, drugid, num_nodes])
+        drug_graph_nodes.append(pd.DataFrame({'graph_id': drugid, 'atom_num': list(druginfo['atom_num'])}))
+    drug_graph_edges = pd.concat(drug_graph_edges, ignore_index=True)
+    drug_graph_properties = pd.DataFrame(drug_graph_properties, columns=['graph_id', 'label', 'num_nodes'])
+    drug_graph_nodes = pd.concat(drug_graph_nodes, ignore_index=True)
+
+    # the atom numbers are transformed into the one-hot features of the atoms in the model
+    atomnum2id_dict = {atom: i for i, atom in enumerate(sorted(set(drug_graph_nodes['atom_num'])))}
+    with open(output_prefix + 'atomnum2id_dict.pickle', 'wb') as out_file:
+        pickle.dump(atomnum2id_dict, out_file)
+    drug_graph_edges.to_csv(output_prefix + 'drug_graph_edges.csv', index=0)
+    drug_graph_properties.to_csv(output_prefix + 'drug_graph_properties.csv', index=0)
+    drug_graph_nodes.to_csv(output_prefix + 'drug_graph_nodes.csv', index=0)
+
+    scipy.sparse.save_npz(output_prefix + 'ECFP6_DNN_coomatrix.npz', scipy.sparse.coo_matrix(np.array(ECFP6_DNN)))
+
+
+def pair_keys(drugid1, drugid2, num_drug):
+    # int64 key of the unordered drug pair
+    drugid1, drugid2 = np.asarray(drugid1, dtype=np.int64), np.asarray(drugid2, dtype=np.int64)
+    return np.minimum(drugid1, drugid2) * num_drug + np.maximum(drugid1, drugid2)
+
+
+def build_se_labels(drugcomb, pair_se, num_drug, num_se):
+    # multi-label side effect matrix (csr, float32) of the drugcomb samples: the side effects of the TWOSIDES rows of
+    # the same unordered drug pair, joined on the pair key instead of searching twosides for every sample
+    sample_keys = pd.DataFrame({'row': np.arange(drugcomb.shape[0]),
+                                'pair': pair_keys(drugcomb['drugid1'], drugcomb['drugid2'], num_drug)})
+    positives = sample_keys.merge(pair_se, on='pair', how='inner')
+    se_label = scipy.sparse.csr_matrix(
+        (np.ones(len(positives), dtype='float32'), (positives['row'].to_numpy(), positives['se'].to_numpy())),
+        shape=(drugcomb.shape[0], num_se))
+    se_label.sort_indices()
+    return se_label
+
+
+def build_samples_and_labels(output_prefix, drugcomb_split, twosides_sorted, drug2id_dict, dense_se_labels=False):
+    # drugcomb_split: the drugcomb samples of the training, validation and test sets
+    # the training samples are doubled with the opposite drug order, the val/test samples are doubled in the model
+    se_symbol2id_dict = {se: i for i, se in enumerate(sorted(set(twosides_sorted['Polypharmacy Side Effect'])))}
+    with open(output_prefix + 'se_symbol2id_dict.pickle', 'wb') as out_file:
+        pickle.dump(se_symbol2id_dict, out_file)
+
+    # the side effects of every (unordered) drug pair, grouped once
+    num_drug = len(drug2id_dict)
+    pair_se = pd.DataFrame({'pair': pair_keys(twosides_sorted['drug1_lower'].map(drug2id_dict),
+                                              twosides_sorted['drug2_lower'].map(drug2id_dict), num_drug),
+                            'se': twosides_sorted['Polypharmacy Side Effect'].map(se_symbol2id_dict)}).drop_duplicates()
+
+    samples, labels = {}, {}
+    sample_columns = ['drugid1', 'drugid2', 'cell_line_name'] + te_label_columns
+    for split, drugcomb in zip(['train', 'val', 'test'], drugcomb_split):
+        drugcomb = drugcomb[sample_columns]
+        if split == 'train':
+            drugcomb_ = drugcomb.rename(columns={'drugid1': 'drugid2', 'drugid2': 'drugid1'})[sample_columns]
+            drugcomb = pd.concat([drugcomb, drugcomb_], ignore_index=True)
+        drugcomb = drugcomb.sort_values(['drugid1', 'drugid2'], ascending=(True, True)).reset_index(drop=True)
+
+        samples[split + '_drug_drug_samples'] = np.array(drugcomb, dtype=str)[:, :3]
+        labels[split + '_te_labels'] = drugcomb[te_label_columns].to_numpy(dtype='float32')
+
+        # adverse effect labels based on drugcomb/TE samples (as TE prediction is our main task)
+        # stored as <split>_se_labels.npz (csr), load_HNEMA_DDI_data_te reads both this and the dense format
+        se_label = build_se_labels(drugcomb, pair_se, num_drug, len(se_symbol2id_dict))
+        scipy.sparse.save_npz(output_prefix + split + '_se_labels.npz', se_label)
+        if dense_se_labels:
+            labels[split + '_se_labels'] = se_label.toarray()
+
+    np.savez(output_prefix + 'train_val_test_drug_drug_samples.npz', **samples)
+    np.savez(output_prefix + 'train_val_test_drug_drug_labels.npz', **labels)
+
+
+def build_HNEMA_dataset(source_prefix, output_prefix, num_cellline=20, used_synergy_score='synergy_loewe',
+                        z_threshold=1.64, dtttd_ratio=0.3, random_seed=1012, folds=10, val_fold=8, test_fold=9,
+                        ppi_fix=False, max_chunk_instances=1 << 22, keep_instances=False, dense_se_labels=False):
+    pathlib.Path(output_prefix).mkdir(parents=True, exist_ok=True)
+    drugcomb_alldruginfo_dict, drugcomb, twosides, drug_target, target_target = read_compiled_data(source_prefix, ppi_fix)
+    drugcomb_sorted, twosides_sorted = select_samples(drugcomb, twosides, num_cellline)
+    drug2id_dict, target2id_dict, cellline2id_dict, drugcomb_sorted, drug_target_sorted, target_target_sorted = \
+        build_id_dicts(drugcomb_sorted, drug_target, target_target)
+    num_drug, num_target, num_cellline = len(drug2id_dict), len(target2id_dict), len(cellline2id_dict)
+    print('num_drug:', num_drug, 'num_target:', num_target, 'num_cellline:', num_cellline)
+    for name, name2id_dict in [('drug2id_dict', drug2id_dict), ('target2id_dict', target2id_dict),
+                               ('cellline2id_dict', cellline2id_dict)]:
+        with open(output_prefix + name + '.pickle', 'wb') as out_file:
+            pickle.dump(name2id_dict, out_file)
+
+    train_drugpair_name, val_drugpair_name, test_drugpair_name = split_drug_pairs(
+        drugcomb_sorted, twosides_sorted, random_seed, folds, val_fold, test_fold)
+    drugcomb_split = [drugcomb_sorted[drugcomb_sorted['unified_name'].isin(set(drugpair_name))].reset_index(drop=True)
+                      for drugpair_name in [train_drugpair_name, val_drugpair_name, test_drugpair_name]]
+
+    # only the drug pairs of the training set are put into the heterogeneous network (to prevent data leakage)
+    train_drug_pairs = drugcomb_split[0][['drugid1', 'drugid2']].to_numpy(dtype=np.int64)
+    te_qualified = qualified_te_pairs(drugcomb_sorted, used_synergy_score, z_threshold)
+    train_te_pairs = [(id1, id2) for id1, id2 in train_drug_pairs if (id1, id2) in te_qualified or (id2, id1) in te_qualified]
+    adjM, type_mask = build_adjacency(num_drug, num_target, num_cellline, drug_target_sorted, target_target_sorted,
+                                      symmetric_pairs(train_drug_pairs))
+    scipy.sparse.save_npz(output_prefix + 'adjM.npz', adjM)
+    np.save(output_prefix + 'node_types.npy', type_mask)
+
+    metapath_indices_mapping = enumerate_metapaths(adjM, num_drug, num_target, train_te_pairs, train_drug_pairs,
+                                                   output_prefix + 'metapath_instances/', dtttd_ratio, random_seed,
+                                                   max_chunk_instances)
+    for metapath, edge_metapath_idx_array in metapath_indices_mapping.items():
+        print('-'.join(map(str, metapath)), 'shape:', edge_metapath_idx_array.shape)
+    export_metapaths(output_prefix, metapath_indices_mapping, num_drug, max_chunk_instances)
+    del metapath_indices_mapping
+    if not keep_instances:
+        shutil.rmtree(output_prefix + 'metapath_instances/')
+
+    build_samples_and_labels(output_prefix, drugcomb_split, twosides_sorted, drug2id_dict, dense_se_labels)
+    build_drug_graphs(output_prefix, drugcomb_alldruginfo_dict, drug2id_dict)
+
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser(description='HNEMA dataset builder (the files in data4training_model)')
+    ap.add_argument('--source-prefix', type=str, default='./data/original_compiled_data/',
+                    help='root from which to read the compiled files (drugcomb.csv, twosides.csv, drug_target_inter.csv, target_target_inter.csv, drugcomb_alldruginfo_dict.pickle)')
+    ap.add_argument('--output-prefix', type=str, default='./data/data4training_model/',
+                    help='root to which the model training files are written')
+    ap.add_argument('--num-cellline', type=int, default=20,
+                    help='Number of the cell lines (with the most samples) kept. Default is 20.')
+    ap.add_argument('--synergy-score', default='synergy_loewe',
+                    help='Synergy score used to select the drug pairs of the drug-te-drug metapath. Default is synergy_loewe.')
+    ap.add_argument('--z-threshold', type=float, default=1.64,
+                    help='z-score threshold of the synergy score of the drug-te-drug metapath. Default is 1.64.')
+    ap.add_argument('--dtttd-ratio', type=float, default=0.3,
+                    help='Sampling ratio of the end drugs of the drug-target-target-target-drug metapath (1 to keep all the instances). Default is 0.3.')
+    ap.add_argument('--seed', type=int, default=1012,
+                    help='Seed of the data split and the metapath sampling. Default is 1012.')
+    ap.add_argument('--ppi-fix', action='store_true',
+                    help='whether to correct the wrong gene symbol of the original target_target_inter.csv (as in the notebook, '
+                         'only for the original PPI file)')
+    ap.add_argument('--max-chunk-instances', type=int, default=1 << 22,
+                    help='Maximum number of the metapath instances enumerated, sorted and exported in memory at a time. Default is 4194304.')
+    ap.add_argument('--keep-instances', action='store_true',
+                    help='whether to keep the sorted metapath instances (metapath_instances/<metapath>.npy) after the export')
+    ap.add_argument('--dense-se-labels', action='store_true',
+                    help='whether to write the dense side effect labels into train_val_test_drug_drug_labels.npz as well (the format read by the earlier versions)')
+
+    args = ap.parse_args()
+    build_HNEMA_dataset(args.source_prefix, args.output_prefix, args.num_cellline, args.synergy_score, args.z_threshold,
+                        args.dtttd_ratio, args.seed, ppi_fix=args.ppi_fix,
+                        max_chunk_instances=args.max_chunk_instances, keep_instances=args.keep_instances,
+                        dense_se_labels=args.dense_se_labels)
@@ -1,18 +1,23 @@
 # Instead of the framework name in the manuscript (i.e., Muthene), we use HNEMA (Heterogeneous Network Embedding with Meta-path Aggregation) here to define the function.
 # Besides, we sincerely thank Fu et al. open the source code of MAGNN at https://github.com/cynricfu/MAGNN. MAGNN helps us to finish message passing of nodes on heterogeneous network.
+import os
 import time
 import argparse
 import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch.nn.parallel import DistributedDataParallel
 import torch.nn.functional as F
 from torch.optim import lr_scheduler
 from torch.nn.utils import clip_grad_norm_
 import numpy as np
 from sklearn.metrics import roc_auc_score, average_precision_score, precision_recall_curve, auc
-from model.Auxiliary_networks import side_effect_predictor, therapeutic_effect_DNN_predictor
+from model.Auxiliary_networks import side_effect_predictor, therapeutic_effect_DNN_predictor, drug_fingerprint_bag
 from model.HNEMA_link_prediction import HNEMA_link_prediction
 from utils.pytorchtools import EarlyStopping
 from utils.data import load_HNEMA_DDI_data_te
-from utils.tools import index_generator, parse_minibatch
+from utils.tools import index_generator, parse_minibatch, parse_minibatch_unique, metapath_subgraph_cache, minibatch_prefetcher, \
+    multilabel_targets
 from sklearn.preprocessing import MinMaxScaler
 from sklearn.metrics import mean_squared_error, mean_absolute_error
 import random
@@ -63,14 +68,90 @@ only_test = False
 # S_mean, synergy_zip, synergy_loewe, synergy_hsa, synergy_bliss (corresponding to 0,1,2,3,4, respectively)
 predicted_te_type = 2
 
+
+def compute_drug_embedding_table(main_net, adjlists_ua, edge_metapath_indices_list_ua, features_list, type_mask,
+                                 device, samples=None, seed=0, unique=True, save_path=None):
+    # compute the main_net embeddings of all drugs at once
+    # with samples=None every drug uses its full metapath neighborhood, otherwise the neighbors are sampled with seed
+    # the table can be stored as a .npy file for later scoring
+    drug_subgraph_cache = metapath_subgraph_cache(adjlists_ua, edge_metapath_indices_list_ua, num_drug, samples, seed,
+                                                  num_drug)
+    all_drug_idx = np.repeat(np.arange(num_drug)[:, None], 2, axis=1).tolist()
+    drug_minibatch = drug_subgraph_cache.parse_minibatch(all_drug_idx, device, unique)
+    main_net.eval()
+    with torch.no_grad():
+        [drug_embedding_table, _], _, _ = main_net(
+            (drug_minibatch[0], features_list, type_mask, drug_minibatch[1], drug_minibatch[2]) + tuple(drug_minibatch[3:]))
+    if save_path is not None:
+        np.save(save_path, drug_embedding_table.cpu().numpy())
+    return drug_embedding_table
+
+
+def score_drug_triples(drug_embedding_table, all_drug_morgan, se_net, te_net, drug_drug_idx, cellline_idx,
+                       output_concat, batch_size=1024, symmetric=True, fingerprint_bag=None):
+    # score (drug1, drug2, cell line) triples with the TE/SE heads using the precomputed drug embedding table
+    # symmetric: average the predictions of both drug orders, as in the val/test loops
+    # fingerprint_bag: the sparse fingerprints (drug_fingerprint_bag) used instead of the dense all_drug_morgan
+    sigmoid = torch.nn.Sigmoid()
+    device = drug_embedding_table.device
+    if fingerprint_bag is not None:
+        drug_composite_table = drug_embedding_table
+    else:
+        drug_composite_table = torch.cat((drug_embedding_table, all_drug_morgan.to(device)), axis=1)
+    drug_drug_idx = torch.tensor(np.asarray(drug_drug_idx), dtype=torch.int64).to(device)
+    cellline_idx = torch.tensor(np.asarray(cellline_idx), dtype=torch.int64).to(device)
+
+    se_net.eval()
+    te_net.eval()
+    te_results, se_results = [], []
+    with torch.no_grad():
+        for start in range(0, drug_drug_idx.shape[0], batch_size):
+            drug_drug_batch = drug_drug_idx[start:start + batch_size]
+            cellline_batch = cellline_idx[start:start + batch_size]
+            if symmetric:
+                drug_drug_batch = torch.cat([drug_drug_batch, drug_drug_batch[:, [1, 0]]], dim=0)
+                cellline_batch = torch.cat([cellline_batch, cellline_batch], dim=0)
+            row_drug_composite_embedding = drug_composite_table[drug_drug_batch[:, 0]]
+            col_drug_composite_embedding = drug_composite_table[drug_drug_batch[:, 1]]
+            fingerprint = (fingerprint_bag, drug_drug_batch[:, 0], drug_drug_batch[:, 1]) if fingerprint_bag is not None else None
+
+            se_output = sigmoid(se_net(row_drug_composite_embedding, col_drug_composite_embedding, fingerprint))
+            if output_concat == True:
+                te_output = te_net(row_drug_composite_embedding, col_drug_composite_embedding, cellline_batch, se_output, fingerprint=fingerprint)
+            else:
+                te_output = te_net(row_drug_composite_embedding, col_drug_composite_embedding, cellline_batch, fingerprint=fingerprint)
+
+            if symmetric:
+                se_output = (se_output[:se_output.shape[0] // 2, :] + se_output[se_output.shape[0] // 2:, :]) / 2
+                te_output = (te_output[:te_output.shape[0] // 2, :] + te_output[te_output.shape[0] // 2:, :]) / 2
+            te_results.append(te_output)
+            se_results.append(se_output)
+    return torch.cat(te_results), torch.cat(se_results)
+
+
 def run_model_HNEMA_DDI(root_prefix, hidden_dim_main, num_heads_main, attnvec_dim_main, rnn_type_main,
                         num_epochs, patience, batch_size, neighbor_samples, repeat, attn_switch_main, rnn_concat_main,
-                        hidden_dim_aux, loss_ratio_te, loss_ratio_se, layer_list, pred_in_dropout, pred_out_dropout, output_concat, args):
+                        hidden_dim_aux, loss_ratio_te, loss_ratio_se, layer_list, pred_in_dropout, pred_out_dropout, output_concat, args,
+                        data=None):
 
     print('current paramters:',loss_ratio_te, loss_ratio_se, output_concat, hidden_dim_aux, rnn_type_main)
-    adjlists_ua, edge_metapath_indices_list_ua, adjM, type_mask, name2id_dict, train_val_test_drug_drug_samples, train_val_test_drug_drug_labels, all_drug_morgan = load_HNEMA_DDI_data_te(root_prefix)
-
-    device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
+    if data is None:
+        data = load_HNEMA_DDI_data_te(root_prefix, args.csr_store, args.sparse_se_labels)
+    adjlists_ua, edge_metapath_indices_list_ua, adjM, type_mask, name2id_dict, train_val_test_drug_drug_samples, train_val_test_drug_drug_labels, all_drug_morgan = data
+
+    if args.seed is not None:
+        random.seed(args.seed)
+        np.random.seed(args.seed)
+        torch.manual_seed(args.seed)
+        torch.cuda.manual_seed_all(args.seed)
+
+    # distributed training (--world-size > 1): this process is one of the ranks started by distributed_worker
+    distributed = args.world_size > 1
+    rank = args.rank if distributed else 0
+    if distributed and torch.cuda.is_available():
+        device = torch.device('cuda:{}'.format(rank % torch.cuda.device_count()))
+    else:
+        device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
     # device = torch.device('cpu')
     features_list = []
     in_dims = []
@@ -84,12 +165,22 @@ def run_model_HNEMA_DDI(root_prefix, hidden_dim_main, num_heads_main, attnvec_di
         features_list.append(torch.sparse.FloatTensor(indices, values, torch.Size([dim, dim])).to(device))
 
     # ECFP6 of drugs
-    morgan_values = all_drug_morgan.data
-    morgan_indices = np.vstack((all_drug_morgan.row, all_drug_morgan.col))
-    i = torch.LongTensor(morgan_indices)
-    v = torch.FloatTensor(morgan_values)
-    shape = all_drug_morgan.shape
-    all_drug_morgan = torch.sparse.FloatTensor(i, v, torch.Size(shape)).to_dense().to(device)
+    morgan_dim = all_drug_morgan.shape[1]
+    if args.sparse_fingerprint:
+        # the predictors read the active bits of the fingerprints instead of the concatenated dense fingerprints
+        fingerprint_bag = drug_fingerprint_bag(all_drug_morgan, device)
+        all_drug_morgan = None
+    else:
+        fingerprint_bag = None
+        morgan_values = all_drug_morgan.data
+        morgan_indices = np.vstack((all_drug_morgan.row, all_drug_morgan.col))
+        i = torch.LongTensor(morgan_indices)
+        v = torch.FloatTensor(morgan_values)
+        shape = all_drug_morgan.shape
+        all_drug_morgan = torch.sparse.FloatTensor(i, v, torch.Size(shape)).to_dense().to(device)
+
+    # reduced precision of the autocast regions (--amp), None for fp32
+    amp_dtype = {'none': None, 'fp16': torch.float16, 'bf16': torch.bfloat16}[args.amp]
 
     loss_ratio_te = torch.tensor(loss_ratio_te, dtype=torch.float32).to(device)
     loss_ratio_se = torch.tensor(loss_ratio_se, dtype=torch.float32).to(device)
@@ -101,7 +192,8 @@ def run_model_HNEMA_DDI(root_prefix, hidden_dim_main, num_heads_main, attnvec_di
     # scaler.fit(train_te_temp_labels)
     # train_te_temp_labels = scaler.transform(train_te_temp_labels)
     train_te_labels = torch.tensor(train_te_temp_labels,dtype=torch.float32).to(device)
-    train_se_labels = torch.tensor(train_val_test_drug_drug_labels['train_se_labels'],dtype=torch.float32).to(device)
+    # sparse_se_labels: the side effect labels are densified per batch
+    train_se_labels = multilabel_targets(train_val_test_drug_drug_labels['train_se_labels'], device, args.sparse_se_labels)
 
     # an extra test about exchanging the val and test set
     val_drug_drug_samples = train_val_test_drug_drug_samples['val_drug_drug_samples']
@@ -110,17 +202,40 @@ def run_model_HNEMA_DDI(root_prefix, hidden_dim_main, num_heads_main, attnvec_di
     val_te_temp_labels = train_val_test_drug_drug_labels['val_te_labels'][:, predicted_te_type].reshape(-1, 1)
     # test_te_temp_labels = scaler.transform(test_te_temp_labels)
     val_te_labels = torch.tensor(val_te_temp_labels,dtype=torch.float32).to(device)
-    val_se_labels = torch.tensor(train_val_test_drug_drug_labels['val_se_labels'],dtype=torch.float32).to(device)
+    val_se_labels = multilabel_targets(train_val_test_drug_drug_labels['val_se_labels'], device, args.sparse_se_labels)
 
     test_te_temp_labels = train_val_test_drug_drug_labels['test_te_labels'][:, predicted_te_type].reshape(-1, 1)
     # val_te_temp_labels = scaler.transform(val_te_temp_labels)
     test_te_labels = torch.tensor(test_te_temp_labels,dtype=torch.float32).to(device)
-    test_se_labels = torch.tensor(train_val_test_drug_drug_labels['test_se_labels'],dtype=torch.float32).to(device)
+    test_se_labels = multilabel_targets(train_val_test_drug_drug_labels['test_se_labels'], device, args.sparse_se_labels)
 
     # atomnum2id_dict = name2id_dict[-1]
     se_symbol2id_dict = name2id_dict[-2]
     cellline2id_dict = name2id_dict[-3]
 
+    # everything a training step needs from the sampled indices (run in background threads when --prefetch is used)
+    def prepare_train_minibatch(train_sample_idx_batch, rng=None):
+        train_sample_idx_batch.sort()
+        train_drug_drug_batch = train_drug_drug_samples[train_sample_idx_batch].tolist()
+        train_drug_drug_idx = (np.array(train_drug_drug_batch)[:, :-1].astype(int)).tolist()
+        train_cellline_symbol = (np.array(train_drug_drug_batch)[:, -1]).tolist()
+        train_cellline_idx = [cellline2id_dict[i] for i in train_cellline_symbol]
+
+        if args.dedup_drugs:
+            train_minibatch = parse_minibatch_unique(adjlists_ua, edge_metapath_indices_list_ua, train_drug_drug_idx, device, neighbor_samples, use_masks, num_drug, rng)
+        else:
+            train_minibatch = parse_minibatch(adjlists_ua, edge_metapath_indices_list_ua, train_drug_drug_idx, device, neighbor_samples, use_masks, num_drug, rng)
+        return train_sample_idx_batch, train_drug_drug_idx, train_cellline_idx, train_minibatch
+
+    # deterministic metapath neighborhoods for val/test, sampled once for every drug
+    if args.eval_seed is not None:
+        eval_subgraph_cache = metapath_subgraph_cache(adjlists_ua, edge_metapath_indices_list_ua, num_drug,
+                                                      neighbor_samples, args.eval_seed, num_drug)
+    else:
+        eval_subgraph_cache = None
+
+    # the runs started at the same time (e.g., by HNEMA_sweep.py) are told apart by their name
+    run_suffix = '_' + args.run_name if args.run_name else ''
     mse_list = []
     rmse_list = []
     mae_list = []
@@ -129,16 +244,18 @@ def run_model_HNEMA_DDI(root_prefix, hidden_dim_main, num_heads_main, attnvec_di
     for _ in range(repeat):
         main_net = HNEMA_link_prediction(
             [4], in_dims[:-1], hidden_dim_main, hidden_dim_main, num_heads_main, attnvec_dim_main, rnn_type_main,
-            dropout_rate, attn_switch_main, rnn_concat_main, args)
+            dropout_rate, attn_switch_main, rnn_concat_main, args, sparse_projection=args.sparse_projection,
+            instance_dedup=args.instance_dedup, fused_rnn=args.fused_rnn, transformer_layers=args.transformer_layers,
+            attention_fuse=args.attention_fuse)
         main_net.to(device)
 
         te_layer_list = copy.deepcopy(layer_list)
         te_layer_list.append(1)
         print('TE_layer_list:', te_layer_list)
-        se_net = side_effect_predictor(hidden_dim_main + all_drug_morgan.shape[1], len(se_symbol2id_dict))
+        se_net = side_effect_predictor(hidden_dim_main + morgan_dim, len(se_symbol2id_dict))
         se_net.to(device)
         # 参数：cell line/tissue type总个数，输入药物pair embedding维度，内部生成的cell line/tissue type embedding维度(使用和GIN统一的embedding维度)，输出维度, 是否选择拼接se output, se output数据的维度
-        te_net = therapeutic_effect_DNN_predictor(len(cellline2id_dict), hidden_dim_main + all_drug_morgan.shape[1], hidden_dim_aux, te_layer_list, output_concat, len(se_symbol2id_dict), pred_out_dropout, pred_in_dropout)
+        te_net = therapeutic_effect_DNN_predictor(len(cellline2id_dict), hidden_dim_main + morgan_dim, hidden_dim_aux, te_layer_list, output_concat, len(se_symbol2id_dict), pred_out_dropout, pred_in_dropout)
         te_net.to(device)
         sigmoid = torch.nn.Sigmoid()
 
@@ -148,27 +265,60 @@ def run_model_HNEMA_DDI(root_prefix, hidden_dim_main, num_heads_main, attnvec_di
             lr=lr, weight_decay=weight_decay)
 
         scheduler = lr_scheduler.StepLR(optimizer, step_size=5, gamma=0.5)
+        grad_scaler = torch.amp.GradScaler('cuda', enabled=amp_dtype == torch.float16 and device.type == 'cuda')
 
         main_net.train()
         se_net.train()
         te_net.train()
 
+        if distributed:
+            # the gradients of the training steps are all-reduced over the ranks
+            # (some parameters of main_net, e.g., of unused branches, get no gradient in a step)
+            device_ids = [device] if device.type == 'cuda' else None
+            train_main_net = DistributedDataParallel(main_net, device_ids=device_ids, find_unused_parameters=True)
+            train_se_net = DistributedDataParallel(se_net, device_ids=device_ids)
+            train_te_net = DistributedDataParallel(te_net, device_ids=device_ids)
+        else:
+            train_main_net, train_se_net, train_te_net = main_net, se_net, te_net
+
         if only_test == True:
             temp_prefix = './data/data4training_model/checkpoint/'
             # change it to your trained model
             model_save_path = temp_prefix + 'checkpoint.pt'
         else:
-            model_save_path = root_prefix + 'checkpoint/checkpoint_{}.pt'.format(time.strftime("%Y_%m_%d_%H_%M_%S", time.localtime()))
-
-        early_stopping = EarlyStopping(patience=patience, verbose=True, save_path=model_save_path)
+            model_save_path = root_prefix + 'checkpoint/checkpoint_{}{}.pt'.format(time.strftime("%Y_%m_%d_%H_%M_%S", time.localtime()), run_suffix)
+        if distributed:
+            # all ranks use the checkpoint name of rank 0, which is the only one saving it
+            model_save_path_list = [model_save_path]
+            dist.broadcast_object_list(model_save_path_list, src=0)
+            model_save_path = model_save_path_list[0]
+
+        early_stopping = EarlyStopping(patience=patience, verbose=True, save_path=model_save_path if rank == 0 else None,
+                                       async_save=args.async_checkpoint, keep_top_k=args.keep_top_k)
         # three lists keeping the time of different training phases
         dur1 = []  # data processing before feeding data in an iteration
         dur2 = []  # the training time for an iteration
         dur3 = []  # the time to use grad to update parameters of the model
 
-        train_sample_idx_generator = index_generator(batch_size=batch_size, num_data=len(train_drug_drug_samples))
+        if distributed:
+            # every rank samples batch_size training samples of its own shard per step
+            train_sample_idx_generator = index_generator(batch_size=batch_size, num_data=len(train_drug_drug_samples),
+                                                         rank=rank, world_size=args.world_size, seed=args.dist_seed)
+        else:
+            train_sample_idx_generator = index_generator(batch_size=batch_size, num_data=len(train_drug_drug_samples))
+        if args.prefetch > 0:
+            # the minibatches of the next steps are sampled concurrently with the current training step
+            train_minibatch_loader = minibatch_prefetcher(train_sample_idx_generator, prepare_train_minibatch,
+                                                          args.prefetch_workers, args.prefetch)
+        else:
+            train_minibatch_loader = None
         # reason for batch_size=batch_size//2: to generate the drug-drug pairs with the opposite drug order in val/test phases
-        val_sample_idx_generator = index_generator(batch_size=batch_size//2, num_data=len(val_drug_drug_samples), shuffle=False)
+        if distributed:
+            # the val samples are sharded as well, and the val loss is averaged over the ranks
+            val_sample_idx_generator = index_generator(batch_size=batch_size//2, num_data=len(val_drug_drug_samples), shuffle=False,
+                                                       rank=rank, world_size=args.world_size)
+        else:
+            val_sample_idx_generator = index_generator(batch_size=batch_size//2, num_data=len(val_drug_drug_samples), shuffle=False)
         test_sample_idx_generator = index_generator(batch_size=batch_size//2, num_data=len(test_drug_drug_samples), shuffle=False)
 
         te_criterion = torch.nn.MSELoss(reduction='mean')
@@ -186,50 +336,54 @@ def run_model_HNEMA_DDI(root_prefix, hidden_dim_main, num_heads_main, attnvec_di
                 for iteration in range(train_sample_idx_generator.num_iterations()):
                     t0 = time.time()
 
-                    train_sample_idx_batch = train_sample_idx_generator.next()
-                    train_sample_idx_batch.sort()
-
-                    train_drug_drug_batch = train_drug_drug_samples[train_sample_idx_batch].tolist()
+                    if train_minibatch_loader is not None:
+                        train_sample_idx_batch, train_drug_drug_idx, train_cellline_idx, train_minibatch = train_minibatch_loader.next()
+                    else:
+                        train_sample_idx_batch, train_drug_drug_idx, train_cellline_idx, train_minibatch = prepare_train_minibatch(train_sample_idx_generator.next())
                     train_te_labels_batch = train_te_labels[train_sample_idx_batch]
                     train_se_labels_batch = train_se_labels[train_sample_idx_batch]
-
-                    train_drug_drug_idx = (np.array(train_drug_drug_batch)[:, :-1].astype(int)).tolist()
-                    train_cellline_symbol = (np.array(train_drug_drug_batch)[:, -1]).tolist()
-                    train_cellline_idx = [cellline2id_dict[i] for i in train_cellline_symbol]
-
-                    train_g_lists, train_indices_lists, train_idx_batch_mapped_lists = parse_minibatch(adjlists_ua, edge_metapath_indices_list_ua, train_drug_drug_idx, device, neighbor_samples,use_masks, num_drug)
+                    train_g_lists, train_indices_lists, train_idx_batch_mapped_lists = train_minibatch[:3]
 
                     t1 = time.time()
                     dur1.append(t1 - t0)
 
-                    [row_drug_embedding, col_drug_embedding], _, [row_drug_atten, col_drug_atten] = main_net((train_g_lists, features_list, type_mask[:num_drug + num_target], train_indices_lists, train_idx_batch_mapped_lists))
+                    # the forward pass runs in reduced precision with --amp, the losses are computed in fp32
+                    with torch.autocast(device_type=device.type, dtype=amp_dtype, enabled=amp_dtype is not None):
+                        [row_drug_embedding, col_drug_embedding], _, [row_drug_atten, col_drug_atten] = train_main_net((train_g_lists, features_list, type_mask[:num_drug + num_target], train_indices_lists, train_idx_batch_mapped_lists) + tuple(train_minibatch[3:]))
 
-                    train_drug_drug_idx = torch.tensor(train_drug_drug_idx, dtype=torch.int64).to(device)
-                    train_cellline_idx = torch.tensor(train_cellline_idx, dtype=torch.int64).to(device)
-                    row_drug_batch, col_drug_batch = train_drug_drug_idx[:, 0], train_drug_drug_idx[:, 1]
-                    row_drug_struc_embedding, col_drug_struc_embedding = all_drug_morgan[row_drug_batch], all_drug_morgan[col_drug_batch]
+                        train_drug_drug_idx = torch.tensor(train_drug_drug_idx, dtype=torch.int64).to(device)
+                        train_cellline_idx = torch.tensor(train_cellline_idx, dtype=torch.int64).to(device)
+                        row_drug_batch, col_drug_batch = train_drug_drug_idx[:, 0], train_drug_drug_idx[:, 1]
+                        if fingerprint_bag is not None:
+                            row_drug_composite_embedding, col_drug_composite_embedding = row_drug_embedding, col_drug_embedding
+                            fingerprint = (fingerprint_bag, row_drug_batch, col_drug_batch)
+                        else:
+                            row_drug_struc_embedding, col_drug_struc_embedding = all_drug_morgan[row_drug_batch], all_drug_morgan[col_drug_batch]
 
-                    row_drug_composite_embedding = torch.cat((row_drug_embedding, row_drug_struc_embedding), axis=1)
-                    col_drug_composite_embedding = torch.cat((col_drug_embedding, col_drug_struc_embedding), axis=1)
+                            row_drug_composite_embedding = torch.cat((row_drug_embedding, row_drug_struc_embedding), axis=1)
+                            col_drug_composite_embedding = torch.cat((col_drug_embedding, col_drug_struc_embedding), axis=1)
+                            fingerprint = None
 
-                    se_output = sigmoid(se_net(row_drug_composite_embedding, col_drug_composite_embedding))
-                    if output_concat==True:
-                        se_output_ = se_output.clone().detach()
-                        te_output = te_net(row_drug_composite_embedding, col_drug_composite_embedding, train_cellline_idx, se_output_)
-                    else:
-                        te_output = te_net(row_drug_composite_embedding, col_drug_composite_embedding, train_cellline_idx)
+                        se_output = sigmoid(train_se_net(row_drug_composite_embedding, col_drug_composite_embedding, fingerprint))
+                        if output_concat==True:
+                            se_output_ = se_output.clone().detach()
+                            te_output = train_te_net(row_drug_composite_embedding, col_drug_composite_embedding, train_cellline_idx, se_output_, fingerprint=fingerprint)
+                        else:
+                            te_output = train_te_net(row_drug_composite_embedding, col_drug_composite_embedding, train_cellline_idx, fingerprint=fingerprint)
 
-                    te_loss = te_criterion(te_output, train_te_labels_batch)
-                    se_loss = se_criterion(se_output, train_se_labels_batch)
+                    te_loss = te_criterion(te_output.float(), train_te_labels_batch)
+                    se_loss = se_criterion(se_output.float(), train_se_labels_batch)
                     train_total_loss_batch = loss_ratio_te * te_loss + loss_ratio_se * se_loss
 
                     t2 = time.time()
                     dur2.append(t2 - t1)
                     # autograd
                     optimizer.zero_grad()
-                    train_total_loss_batch.backward()
+                    # the loss scaling is only enabled for fp16 on cuda, otherwise these calls are the plain backward/step
+                    grad_scaler.scale(train_total_loss_batch).backward()
                     # clip_grad_norm_(itertools.chain(main_net.parameters(), drug_net.parameters(), te_net.parameters(), se_net.parameters()), max_norm=10, norm_type=2)
-                    optimizer.step()
+                    grad_scaler.step(optimizer)
+                    grad_scaler.update()
                     t3 = time.time()
                     dur3.append(t3 - t2)
                     if iteration % 100 == 0:
@@ -256,24 +410,38 @@ def run_model_HNEMA_DDI(root_prefix, hidden_dim_main, num_heads_main, attnvec_di
                         val_cellline_symbol = (np.array(val_drug_drug_batch_combined)[:, -1]).tolist()
                         val_cellline_idx = [cellline2id_dict[i] for i in val_cellline_symbol]
 
-                        val_g_lists, val_indices_lists, val_idx_batch_mapped_lists = parse_minibatch(adjlists_ua, edge_metapath_indices_list_ua, val_drug_drug_idx, device, neighbor_samples, no_masks, num_drug)
-
-                        [row_drug_embedding, col_drug_embedding], _, [row_drug_atten, col_drug_atten] = main_net((val_g_lists, features_list, type_mask[:num_drug + num_target], val_indices_lists, val_idx_batch_mapped_lists))
-
-                        val_drug_drug_idx = torch.tensor(val_drug_drug_idx, dtype=torch.int64).to(device)
-                        val_cellline_idx = torch.tensor(val_cellline_idx, dtype=torch.int64).to(device)
-                        row_drug_batch, col_drug_batch = val_drug_drug_idx[:, 0], val_drug_drug_idx[:, 1]
-                        row_drug_struc_embedding, col_drug_struc_embedding = all_drug_morgan[row_drug_batch], all_drug_morgan[col_drug_batch]
-
-                        row_drug_composite_embedding = torch.cat((row_drug_embedding, row_drug_struc_embedding), axis=1)
-                        col_drug_composite_embedding = torch.cat((col_drug_embedding, col_drug_struc_embedding), axis=1)
-
-                        se_output = sigmoid(se_net(row_drug_composite_embedding, col_drug_composite_embedding))
-                        if output_concat == True:
-                            se_output_ = se_output.clone().detach()
-                            te_output = te_net(row_drug_composite_embedding, col_drug_composite_embedding, val_cellline_idx, se_output_)
+                        if eval_subgraph_cache is not None:
+                            val_minibatch = eval_subgraph_cache.parse_minibatch(val_drug_drug_idx, device, args.dedup_drugs)
+                        elif args.dedup_drugs:
+                            val_minibatch = parse_minibatch_unique(adjlists_ua, edge_metapath_indices_list_ua, val_drug_drug_idx, device, neighbor_samples, no_masks, num_drug)
                         else:
-                            te_output = te_net(row_drug_composite_embedding, col_drug_composite_embedding, val_cellline_idx)
+                            val_minibatch = parse_minibatch(adjlists_ua, edge_metapath_indices_list_ua, val_drug_drug_idx, device, neighbor_samples, no_masks, num_drug)
+                        val_g_lists, val_indices_lists, val_idx_batch_mapped_lists = val_minibatch[:3]
+
+                        with torch.autocast(device_type=device.type, dtype=amp_dtype, enabled=amp_dtype is not None):
+                            [row_drug_embedding, col_drug_embedding], _, [row_drug_atten, col_drug_atten] = main_net((val_g_lists, features_list, type_mask[:num_drug + num_target], val_indices_lists, val_idx_batch_mapped_lists) + tuple(val_minibatch[3:]))
+
+                            val_drug_drug_idx = torch.tensor(val_drug_drug_idx, dtype=torch.int64).to(device)
+                            val_cellline_idx = torch.tensor(val_cellline_idx, dtype=torch.int64).to(device)
+                            row_drug_batch, col_drug_batch = val_drug_drug_idx[:, 0], val_drug_drug_idx[:, 1]
+                            if fingerprint_bag is not None:
+                                row_drug_composite_embedding, col_drug_composite_embedding = row_drug_embedding, col_drug_embedding
+                                fingerprint = (fingerprint_bag, row_drug_batch, col_drug_batch)
+                            else:
+                                row_drug_struc_embedding, col_drug_struc_embedding = all_drug_morgan[row_drug_batch], all_drug_morgan[col_drug_batch]
+
+                                row_drug_composite_embedding = torch.cat((row_drug_embedding, row_drug_struc_embedding), axis=1)
+                                col_drug_composite_embedding = torch.cat((col_drug_embedding, col_drug_struc_embedding), axis=1)
+                                fingerprint = None
+
+                            se_output = sigmoid(se_net(row_drug_composite_embedding, col_drug_composite_embedding, fingerprint))
+                            if output_concat == True:
+                                se_output_ = se_output.clone().detach()
+                                te_output = te_net(row_drug_composite_embedding, col_drug_composite_embedding, val_cellline_idx, se_output_, fingerprint=fingerprint)
+                            else:
+                                te_output = te_net(row_drug_composite_embedding, col_drug_composite_embedding, val_cellline_idx, fingerprint=fingerprint)
+
+                        se_output, te_output = se_output.float(), te_output.float()
 
                         # calculate the averaging results of the drug pairs with the opposite drug order
                         se_output = (se_output[:se_output.shape[0]//2,:] + se_output[se_output.shape[0]//2:,:])/2
@@ -282,7 +450,13 @@ def run_model_HNEMA_DDI(root_prefix, hidden_dim_main, num_heads_main, attnvec_di
                         se_loss = se_criterion(se_output, val_se_labels_batch)
                         val_total_loss.append(loss_ratio_te * te_loss + loss_ratio_se * se_loss)
 
-                    val_total_loss=torch.mean(torch.tensor(val_total_loss))
+                    if distributed:
+                        # mean of the val batch losses of all ranks
+                        val_loss_sum = torch.tensor([torch.sum(torch.tensor(val_total_loss)).item(), len(val_total_loss)], dtype=torch.float64).to(device)
+                        dist.all_reduce(val_loss_sum)
+                        val_total_loss = (val_loss_sum[0] / val_loss_sum[1]).float().cpu()
+                    else:
+                        val_total_loss=torch.mean(torch.tensor(val_total_loss))
                     VAL_L0SS.append(val_total_loss.item())
                 t_end = time.time()
                 print('Epoch {:05d} | Val_Loss {:.4f} | Time(s) {:.4f}'.format(
@@ -299,9 +473,21 @@ def run_model_HNEMA_DDI(root_prefix, hidden_dim_main, num_heads_main, attnvec_di
                     print('Early stopping based on the validation loss!')
                     break
 
+        if train_minibatch_loader is not None:
+            train_minibatch_loader.close()
+
+        # the last checkpoint has to be on the disk before it is loaded for the test
+        early_stopping.close()
+
+        if distributed:
+            # the model is tested by rank 0 once its last checkpoint is written
+            dist.barrier()
+            if rank != 0:
+                continue
+
         # model test
         print('The name of loaded model is:', model_save_path)
-        checkpoint=torch.load(model_save_path)
+        checkpoint=torch.load(model_save_path, map_location=device)
         main_net.load_state_dict(checkpoint['main_net'])
         se_net.load_state_dict(checkpoint['se_net'])
         te_net.load_state_dict(checkpoint['te_net'])
@@ -312,46 +498,81 @@ def run_model_HNEMA_DDI(root_prefix, hidden_dim_main, num_heads_main, attnvec_di
         test_te_results, test_se_results = [], []
         test_te_label_list, test_se_label_list = [], []
         with torch.no_grad():
-            for iteration in range(test_sample_idx_generator.num_iterations()):
-                test_sample_idx_batch = test_sample_idx_generator.next()
-                test_drug_drug_batch = test_drug_drug_samples[test_sample_idx_batch]
-                test_drug_drug_batch_ = test_drug_drug_batch[:,[1,0,2]]
-                test_drug_drug_batch_combined = np.concatenate([test_drug_drug_batch,test_drug_drug_batch_],axis=0).tolist()
-
-                test_te_labels_batch = test_te_labels[test_sample_idx_batch]
-                test_se_labels_batch = test_se_labels[test_sample_idx_batch]
-                test_drug_drug_idx = (np.array(test_drug_drug_batch_combined)[:, :-1].astype(int)).tolist()
-                test_cellline_symbol = (np.array(test_drug_drug_batch_combined)[:, -1]).tolist()
-                test_cellline_idx = [cellline2id_dict[i] for i in test_cellline_symbol]
-
-                test_g_lists, test_indices_lists, test_idx_batch_mapped_lists = parse_minibatch(
-                    adjlists_ua, edge_metapath_indices_list_ua, test_drug_drug_idx, device, neighbor_samples,
-                    no_masks, num_drug)
-
-                [row_drug_embedding, col_drug_embedding], _, [row_drug_atten, col_drug_atten] = main_net((test_g_lists, features_list, type_mask[:num_drug + num_target], test_indices_lists, test_idx_batch_mapped_lists))
-
-                test_drug_drug_idx = torch.tensor(test_drug_drug_idx, dtype=torch.int64).to(device)
-                test_cellline_idx = torch.tensor(test_cellline_idx, dtype=torch.int64).to(device)
-                row_drug_batch, col_drug_batch = test_drug_drug_idx[:, 0], test_drug_drug_idx[:, 1]
-                row_drug_struc_embedding, col_drug_struc_embedding = all_drug_morgan[row_drug_batch], all_drug_morgan[col_drug_batch]
-
-                row_drug_composite_embedding = torch.cat((row_drug_embedding, row_drug_struc_embedding), axis=1)
-                col_drug_composite_embedding = torch.cat((col_drug_embedding, col_drug_struc_embedding), axis=1)
-
-                se_output = sigmoid(se_net(row_drug_composite_embedding, col_drug_composite_embedding))
-                if output_concat == True:
-                    se_output_ = se_output.clone().detach()
-                    te_output = te_net(row_drug_composite_embedding, col_drug_composite_embedding, test_cellline_idx, se_output_)
-                else:
-                    te_output = te_net(row_drug_composite_embedding, col_drug_composite_embedding, test_cellline_idx)
-
-                se_output = (se_output[:se_output.shape[0]//2,:] + se_output[se_output.shape[0]//2:,:])/2
-                te_output = (te_output[:te_output.shape[0]//2,:] + te_output[te_output.shape[0]//2:,:])/2
-                test_te_results.append(te_output)
-                # 这样处理可以稍微灵活一点，去记录部分iteration上的结果
-                test_te_label_list.append(test_te_labels_batch)
-                test_se_results.append(se_output)
-                test_se_label_list.append(test_se_labels_batch)
+            if args.table_inference:
+                # drug embeddings depend only on the drug, so they are computed once for all drugs
+                # and the test triples are scored by gathering from the embedding table
+                # the neighbors are sampled (neighbor_samples per drug, as in the per-batch path) with --eval-seed,
+                # or with seed 0 if it is not given, the full neighborhoods would change the results and the peak memory
+                table_seed = args.eval_seed if args.eval_seed is not None else 0
+                drug_embedding_table = compute_drug_embedding_table(
+                    main_net, adjlists_ua, edge_metapath_indices_list_ua, features_list, type_mask[:num_drug + num_target],
+                    device, neighbor_samples, table_seed)
+                test_cellline_idx = [cellline2id_dict[i] for i in test_drug_drug_samples[:, -1]]
+                test_te_output, test_se_output = score_drug_triples(
+                    drug_embedding_table, all_drug_morgan, se_net, te_net, test_drug_drug_samples[:, :-1].astype(int),
+                    test_cellline_idx, output_concat, batch_size, fingerprint_bag=fingerprint_bag)
+                test_te_results.append(test_te_output)
+                test_te_label_list.append(test_te_labels)
+                test_se_results.append(test_se_output)
+                test_se_label_list.append(test_se_labels[:])
+
+            else:
+                for iteration in range(test_sample_idx_generator.num_iterations()):
+                    test_sample_idx_batch = test_sample_idx_generator.next()
+                    test_drug_drug_batch = test_drug_drug_samples[test_sample_idx_batch]
+                    test_drug_drug_batch_ = test_drug_drug_batch[:,[1,0,2]]
+                    test_drug_drug_batch_combined = np.concatenate([test_drug_drug_batch,test_drug_drug_batch_],axis=0).tolist()
+
+                    test_te_labels_batch = test_te_labels[test_sample_idx_batch]
+                    test_se_labels_batch = test_se_labels[test_sample_idx_batch]
+                    test_drug_drug_idx = (np.array(test_drug_drug_batch_combined)[:, :-1].astype(int)).tolist()
+                    test_cellline_symbol = (np.array(test_drug_drug_batch_combined)[:, -1]).tolist()
+                    test_cellline_idx = [cellline2id_dict[i] for i in test_cellline_symbol]
+
+                    if eval_subgraph_cache is not None:
+                        test_minibatch = eval_subgraph_cache.parse_minibatch(test_drug_drug_idx, device, args.dedup_drugs)
+                    elif args.dedup_drugs:
+                        test_minibatch = parse_minibatch_unique(
+                            adjlists_ua, edge_metapath_indices_list_ua, test_drug_drug_idx, device, neighbor_samples,
+                            no_masks, num_drug)
+                    else:
+                        test_minibatch = parse_minibatch(
+                            adjlists_ua, edge_metapath_indices_list_ua, test_drug_drug_idx, device, neighbor_samples,
+                            no_masks, num_drug)
+                    test_g_lists, test_indices_lists, test_idx_batch_mapped_lists = test_minibatch[:3]
+
+                    with torch.autocast(device_type=device.type, dtype=amp_dtype, enabled=amp_dtype is not None):
+                        [row_drug_embedding, col_drug_embedding], _, [row_drug_atten, col_drug_atten] = main_net((test_g_lists, features_list, type_mask[:num_drug + num_target], test_indices_lists, test_idx_batch_mapped_lists) + tuple(test_minibatch[3:]))
+
+                        test_drug_drug_idx = torch.tensor(test_drug_drug_idx, dtype=torch.int64).to(device)
+                        test_cellline_idx = torch.tensor(test_cellline_idx, dtype=torch.int64).to(device)
+                        row_drug_batch, col_drug_batch = test_drug_drug_idx[:, 0], test_drug_drug_idx[:, 1]
+                        if fingerprint_bag is not None:
+                            row_drug_composite_embedding, col_drug_composite_embedding = row_drug_embedding, col_drug_embedding
+                            fingerprint = (fingerprint_bag, row_drug_batch, col_drug_batch)
+                        else:
+                            row_drug_struc_embedding, col_drug_struc_embedding = all_drug_morgan[row_drug_batch], all_drug_morgan[col_drug_batch]
+
+                            row_drug_composite_embedding = torch.cat((row_drug_embedding, row_drug_struc_embedding), axis=1)
+                            col_drug_composite_embedding = torch.cat((col_drug_embedding, col_drug_struc_embedding), axis=1)
+                            fingerprint = None
+
+                        se_output = sigmoid(se_net(row_drug_composite_embedding, col_drug_composite_embedding, fingerprint))
+                        if output_concat == True:
+                            se_output_ = se_output.clone().detach()
+                            te_output = te_net(row_drug_composite_embedding, col_drug_composite_embedding, test_cellline_idx, se_output_, fingerprint=fingerprint)
+                        else:
+                            te_output = te_net(row_drug_composite_embedding, col_drug_composite_embedding, test_cellline_idx, fingerprint=fingerprint)
+
+                    se_output, te_output = se_output.float(), te_output.float()
+
+                    se_output = (se_output[:se_output.shape[0]//2,:] + se_output[se_output.shape[0]//2:,:])/2
+                    te_output = (te_output[:te_output.shape[0]//2,:] + te_output[te_output.shape[0]//2:,:])/2
+                    test_te_results.append(te_output)
+                    # 这样处理可以稍微灵活一点，去记录部分iteration上的结果
+                    test_te_label_list.append(test_te_labels_batch)
+                    test_se_results.append(se_output)
+                    test_se_label_list.append(test_se_labels_batch)
 
             # 在这里获得numpy数据以后，若一开始进行了0-1归一化，这里的结果也是在0-1范围内，需要使用scaler将预测数据和真实数据变回原尺度
             test_te_results = torch.cat(test_te_results)
@@ -386,6 +607,9 @@ def run_model_HNEMA_DDI(root_prefix, hidden_dim_main, num_heads_main, attnvec_di
         pearson_list.append(TE_PEARSON[0])
 
 
+    if rank != 0:
+        return
+
     print('----------------------------------------------------------------')
     print('Link Prediction Tests Summary')
     print('MSE_mean = {}, MSE_std = {}'.format(np.mean(mse_list), np.std(mse_list)))
@@ -394,10 +618,33 @@ def run_model_HNEMA_DDI(root_prefix, hidden_dim_main, num_heads_main, attnvec_di
     print('PEARSON_mean = {}, PEARSON_std = {}'.format(np.mean(pearson_list), np.std(pearson_list)))
 
     pd.DataFrame(VAL_L0SS, columns=['VAL_LOSS']).to_csv(
-        root_prefix+'checkpoint/VAL_LOSS.csv')
+        root_prefix+'checkpoint/VAL_LOSS{}.csv'.format(run_suffix))
 
+    return {'MSE_mean': np.mean(mse_list), 'MSE_std': np.std(mse_list),
+            'RMSE_mean': np.mean(rmse_list), 'RMSE_std': np.std(rmse_list),
+            'MAE_mean': np.mean(mae_list), 'MAE_std': np.std(mae_list),
+            'PEARSON_mean': np.mean(pearson_list), 'PEARSON_std': np.std(pearson_list)}
 
-if __name__ == '__main__':
+
+def run_model_HNEMA_DDI_from_args(args, data=None):
+    # data: the output of load_HNEMA_DDI_data_te if it is already loaded (e.g., shared by the runs of HNEMA_sweep.py)
+    return run_model_HNEMA_DDI(args.root_prefix, args.hidden_dim_main, args.num_heads_main, args.attnvec_dim_main, args.rnn_type_main, args.epoch,
+                               args.patience, args.batch_size, args.samples, args.repeat, args.attn_switch_main, args.rnn_concat_main, args.hidden_dim_aux,
+                               args.loss_ratio_te, args.loss_ratio_se, args.layer_list, args.pred_in_dropout, args.pred_out_dropout, args.output_concat, args,
+                               data)
+
+
+def distributed_worker(rank, args):
+    # one of the --world-size training processes (started by mp.spawn)
+    args.rank = rank
+    # the cpu cores are split among the ranks
+    torch.set_num_threads(max(1, os.cpu_count() // args.world_size))
+    dist.init_process_group(args.dist_backend, init_method=args.dist_init_method, rank=rank, world_size=args.world_size)
+    run_model_HNEMA_DDI_from_args(args)
+    dist.destroy_process_group()
+
+
+def build_arg_parser():
     # part1 (for meta-path embedding generation)
     ap = argparse.ArgumentParser(description='HNE-GIN-DDI testing for drug-drug link prediction')
     ap.add_argument('--root-prefix', type=str,
@@ -410,15 +657,62 @@ if __name__ == '__main__':
     ap.add_argument('--attnvec-dim-main', type=int, default=128,
                     help='Dimension of the attention vector in the main model. Default is 128.')
     ap.add_argument('--rnn-type-main', default='bi-gru',
-                    help='Type of the aggregator in the main model. Default is bi-gru.')
+                    help='Type of the aggregator in the main model (bi-gru, gru, bi-lstm, lstm, mean, transformer or transformer-sdpa). '
+                         'transformer-sdpa computes the same attention as transformer with the fused kernel, but its nn.LayerNorm '
+                         '(biased variance, eps inside the square root) only approximates the LayerNorm of transformer. Default is bi-gru.')
+    ap.add_argument('--transformer-layers', type=int, default=6,
+                    help='Number of encoder blocks of the transformer aggregators. Default is 6.')
     ap.add_argument('--epoch', type=int, default=20, help='Number of epochs. Default is 20.')
     ap.add_argument('--patience', type=int, default=8, help='Patience. Default is 8.')
+    ap.add_argument('--async-checkpoint', action='store_true',
+                    help='whether to write the checkpoints from a cpu snapshot in a background thread instead of blocking the training loop')
+    ap.add_argument('--keep-top-k', type=int, default=1,
+                    help='Number of the best checkpoints kept (the previous ones as checkpoint_..._top2.pt, ...). Default is 1.')
     ap.add_argument('--batch-size', type=int, default=32,
                     help='Batch size. Please choose an odd value, because of the way of calculating val/test labels of our model. Default is 32.')
     ap.add_argument('--samples', type=int, default=100,
                     help='Number of neighbors sampled in the parse function of main model. Default is 100.')
     ap.add_argument('--repeat', type=int, default=1, help='Repeat the training and testing for N times. Default is 1.')
+    ap.add_argument('--seed', type=int, default=None,
+                    help='Seed of python/numpy/torch random numbers (not fixed if it is not given). Default is None.')
+    ap.add_argument('--run-name', type=str, default=None,
+                    help='Name appended to the checkpoint and VAL_LOSS file names of this run. Default is None.')
+    ap.add_argument('--dedup-drugs', action='store_true',
+                    help='whether to encode every drug of a batch only once (for both drug positions and both drug orders) in the main model')
+    ap.add_argument('--table-inference', action='store_true',
+                    help='whether to compute the drug embeddings of all drugs once at test time and score the test samples from this table '
+                         '(the --samples neighbors of every drug are sampled with --eval-seed, or with seed 0 if it is not given)')
+    ap.add_argument('--eval-seed', type=int, default=None,
+                    help='if given, the metapath neighbors of every drug are sampled once with this seed and reused in all val/test batches (deterministic evaluation). Default is None.')
+    ap.add_argument('--prefetch', type=int, default=0,
+                    help='Number of training minibatches prepared in background threads ahead of the current step (0 to disable). Default is 0.')
+    ap.add_argument('--prefetch-workers', type=int, default=1,
+                    help='Number of background threads preparing the prefetched minibatches. Default is 1.')
+    ap.add_argument('--sparse-projection', action='store_true',
+                    help='whether to project only the nodes referenced by the metapath instances of each batch instead of all nodes (the node features are one-hot)')
+    ap.add_argument('--instance-dedup', action='store_true',
+                    help='whether to run the metapath instance encoder only once for the instances repeated in a batch')
+    ap.add_argument('--fused-rnn', action='store_true',
+                    help='whether to encode the instances of all metapaths with one shared (gru/lstm) rnn call on a packed sequence, with a metapath type embedding, instead of one rnn per metapath')
+    ap.add_argument('--amp', choices=['none', 'fp16', 'bf16'], default='none',
+                    help='Precision of the forward passes (autocast, bf16 also on cpu). fp16 uses loss scaling on cuda. Default is none (fp32).')
+    ap.add_argument('--sparse-fingerprint', action='store_true',
+                    help='whether to compute the ECFP6 part of the first TE/SE predictor layers from the active fingerprint bits instead of the dense fingerprints')
+    ap.add_argument('--world-size', type=int, default=1,
+                    help='Number of data-parallel training processes (DistributedDataParallel, every process uses batch-size samples per step). Default is 1.')
+    ap.add_argument('--dist-backend', default='gloo',
+                    help='Backend of the distributed training (gloo also runs on cpu-only nodes, nccl for gpus). Default is gloo.')
+    ap.add_argument('--dist-init-method', default='tcp://127.0.0.1:29500',
+                    help='Address used by the distributed training processes to find each other. Default is tcp://127.0.0.1:29500.')
+    ap.add_argument('--dist-seed', type=int, default=1024,
+                    help='Seed of the training sample order shared by the distributed training processes. Default is 1024.')
+    ap.add_argument('--csr-store', action='store_true',
+                    help='whether to read the metapath neighbors/instances from the memory-mapped binary CSR files (generated from the .adjlist/_idx.pickle files at the first run)')
+    ap.add_argument('--sparse-se-labels', action='store_true',
+                    help='whether to keep the side effect labels as sparse rows of positive side effects on the device and densify them per batch')
     # if it is set to False, the GAT layer will ignore the feature of the central node itself
+    ap.add_argument('--attention-fuse', action='store_true',
+                    help='whether to fuse the metapath-specific outputs by the self-attention among metapaths instead of the metapath-level attention (beta) weighted sum')
     ap.add_argument('--attn-switch-main', default=True,
                     help='whether need to consider the feature of the central node when using GAT layer in the main model')
     ap.add_argument('--rnn-concat-main', default=False,
@@ -440,7 +734,12 @@ if __name__ == '__main__':
     ap.add_argument('--output_concat', default=True,
                     help='Whether put the adverse effect output into therapeutiec effect prediction')
 
-    args = ap.parse_args()
-    run_model_HNEMA_DDI(args.root_prefix, args.hidden_dim_main, args.num_heads_main, args.attnvec_dim_main, args.rnn_type_main, args.epoch,
-                        args.patience, args.batch_size, args.samples, args.repeat, args.attn_switch_main, args.rnn_concat_main, args.hidden_dim_aux,
-                        args.loss_ratio_te, args.loss_ratio_se, args.layer_list, args.pred_in_dropout, args.pred_out_dropout, args.output_concat, args)
+    return ap
+
+
+if __name__ == '__main__':
+    args = build_arg_parser().parse_args()
+    if args.world_size > 1:
+        mp.spawn(distributed_worker, args=(args,), nprocs=args.world_size)
+    else:
+        run_model_HNEMA_DDI_from_args(args)
@@ -0,0 +1,300 @@
+# retrain only the TE/SE predictors of a trained HNEMA model (e.g., on new cell line data)
+# the main_net (HNEMA_link_prediction) is frozen: the embeddings of all drugs are computed once, stored as
+# memory-mapped .npy files, and the predictors are trained by gathering the drug pair embeddings from this table
+import os
+import time
+import argparse
+import torch
+import numpy as np
+from sklearn.metrics import mean_squared_error, mean_absolute_error
+import scipy.stats
+import itertools
+import copy
+from model.Auxiliary_networks import side_effect_predictor, therapeutic_effect_DNN_predictor
+from model.HNEMA_link_prediction import HNEMA_link_prediction
+from utils.pytorchtools import EarlyStopping
+from utils.data import load_HNEMA_DDI_data_te
+from utils.tools import index_generator, multilabel_targets
+from HNEMA_evaluation import num_ntype, dropout_rate, lr, weight_decay, num_drug, num_target, predicted_te_type, \
+    compute_drug_embedding_table, score_drug_triples
+
+
+def compute_drug_embedding_cache(main_net, adjlists_ua, edge_metapath_indices_list_ua, features_list, type_mask,
+                                 device, samples, seed, cache_prefix, refresh=False):
+    # the outputs of the frozen main_net are stored in (and afterwards read from) three .npy files:
+    # cache_prefix + 'drug_embedding.npy': num_drug x out_dim drug embeddings
+    # cache_prefix + 'metapath_outs.npy': num_metapaths x num_drug x (num_heads * hidden_dim) metapath-specific outputs
+    # cache_prefix + 'beta.npy': metapath-level attention over all drugs
+    paths = [cache_prefix + name + '.npy' for name in ['drug_embedding', 'metapath_outs', 'beta']]
+    if refresh or not all(os.path.exists(path) for path in paths):
+        drug_layer = main_net.layer.drug_layer
+        # all drugs are encoded as one deduplicated batch, so the rows of the metapath outputs follow the drug ids
+        # the outputs are kept by the drug layer itself (the metapath-specific layers are not called as modules
+        # when the rnn is fused, so forward hooks on them would not see them)
+        drug_layer.keep_metapath_outs = True
+        try:
+            drug_embedding_table = compute_drug_embedding_table(
+                main_net, adjlists_ua, edge_metapath_indices_list_ua, features_list, type_mask, device, samples, seed)
+            arrays = [drug_embedding_table, drug_layer.metapath_outs, drug_layer.beta.reshape(-1)]
+        finally:
+            drug_layer.keep_metapath_outs = False
+            drug_layer.metapath_outs, drug_layer.beta = None, None
+
+        for path, array in zip(paths, arrays):
+            array = array.cpu().numpy()
+            stored = np.lib.format.open_memmap(path + '.tmp', mode='w+', dtype=np.float32, shape=array.shape)
+            stored[:] = array
+            stored.flush()
+            del stored
+            os.replace(path + '.tmp', path)
+        print('The drug embedding cache is saved to:', cache_prefix)
+    else:
+        print('The drug embedding cache is loaded from:', cache_prefix)
+
+    return [np.load(path, mmap_mode='r') for path in paths]
+
+
+def finetune_heads_HNEMA_DDI(root_prefix, checkpoint_path, hidden_dim_main, num_heads_main, attnvec_dim_main,
+                             rnn_type_main, attn_switch_main, rnn_concat_main, num_epochs, patience, batch_size,
+                             neighbor_samples, hidden_dim_aux, loss_ratio_te, loss_ratio_se, layer_list,
+                             pred_in_dropout, pred_out_dropout, output_concat, args):
+    adjlists_ua, edge_metapath_indices_list_ua, adjM, type_mask, name2id_dict, train_val_test_drug_drug_samples, train_val_test_drug_drug_labels, all_drug_morgan = load_HNEMA_DDI_data_te(root_prefix, args.csr_store, args.sparse_se_labels)
+
+    device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
+    features_list = []
+    in_dims = []
+
+    for i in range(num_ntype):
+        dim = (type_mask == i).sum()
+        in_dims.append(dim)
+        indices = np.vstack((np.arange(dim), np.arange(dim)))
+        indices = torch.LongTensor(indices)
+        values = torch.FloatTensor(np.ones(dim))
+        features_list.append(torch.sparse.FloatTensor(indices, values, torch.Size([dim, dim])).to(device))
+
+    # ECFP6 of drugs
+    morgan_values = all_drug_morgan.data
+    morgan_indices = np.vstack((all_drug_morgan.row, all_drug_morgan.col))
+    i = torch.LongTensor(morgan_indices)
+    v = torch.FloatTensor(morgan_values)
+    shape = all_drug_morgan.shape
+    all_drug_morgan = torch.sparse.FloatTensor(i, v, torch.Size(shape)).to_dense().to(device)
+
+    loss_ratio_te = torch.tensor(loss_ratio_te, dtype=torch.float32).to(device)
+    loss_ratio_se = torch.tensor(loss_ratio_se, dtype=torch.float32).to(device)
+
+    se_symbol2id_dict = name2id_dict[-2]
+    cellline2id_dict = name2id_dict[-3]
+
+    # drug1, drug2, cell line and labels of the train/val/test samples
+    drug_drug_idx, cellline_idx, te_labels, se_labels = {}, {}, {}, {}
+    for phase in ['train', 'val', 'test']:
+        drug_drug_samples = train_val_test_drug_drug_samples['{}_drug_drug_samples'.format(phase)]
+        drug_drug_idx[phase] = drug_drug_samples[:, :-1].astype(int)
+        cellline_idx[phase] = np.array([cellline2id_dict[i] for i in drug_drug_samples[:, -1]])
+        te_labels[phase] = torch.tensor(train_val_test_drug_drug_labels['{}_te_labels'.format(phase)][:, predicted_te_type].reshape(-1, 1), dtype=torch.float32).to(device)
+        se_labels[phase] = multilabel_targets(train_val_test_drug_drug_labels['{}_se_labels'.format(phase)], device, args.sparse_se_labels)
+
+    # the frozen main_net
+    main_net = HNEMA_link_prediction(
+        [4], in_dims[:-1], hidden_dim_main, hidden_dim_main, num_heads_main, attnvec_dim_main, rnn_type_main,
+        dropout_rate, attn_switch_main, rnn_concat_main, args, fused_rnn=args.fused_rnn,
+        transformer_layers=args.transformer_layers, attention_fuse=args.attention_fuse)
+    main_net.to(device)
+    print('The name of loaded model is:', checkpoint_path)
+    checkpoint = torch.load(checkpoint_path, map_location=device)
+    main_net.load_state_dict(checkpoint['main_net'])
+    for p in main_net.parameters():
+        p.requires_grad = False
+
+    if args.cache_prefix is not None:
+        cache_prefix = args.cache_prefix
+    else:
+        cache_prefix = os.path.splitext(checkpoint_path)[0] + '_drug_cache_'
+    drug_embedding_table, metapath_outs, beta = compute_drug_embedding_cache(
+        main_net, adjlists_ua, edge_metapath_indices_list_ua, features_list, type_mask[:num_drug + num_target], device,
+        neighbor_samples, args.seed, cache_prefix, args.refresh_cache)
+    print('metapath-level attention of the drugs:', np.asarray(beta))
+    drug_embedding_table = torch.from_numpy(np.array(drug_embedding_table)).to(device)
+    # drug embedding + ECFP6, gathered for every drug pair
+    drug_composite_table = torch.cat((drug_embedding_table, all_drug_morgan), axis=1)
+
+    te_layer_list = copy.deepcopy(layer_list)
+    te_layer_list.append(1)
+    print('TE_layer_list:', te_layer_list)
+    se_net = side_effect_predictor(hidden_dim_main + all_drug_morgan.shape[1], len(se_symbol2id_dict))
+    se_net.to(device)
+    te_net = therapeutic_effect_DNN_predictor(len(cellline2id_dict), hidden_dim_main + all_drug_morgan.shape[1], hidden_dim_aux, te_layer_list, output_concat, len(se_symbol2id_dict), pred_out_dropout, pred_in_dropout)
+    te_net.to(device)
+    # start from the trained predictors unless they are retrained from scratch (e.g., for a different cell line set)
+    if not args.reset_heads:
+        se_net.load_state_dict(checkpoint['se_net'])
+        te_net.load_state_dict(checkpoint['te_net'])
+    sigmoid = torch.nn.Sigmoid()
+
+    if args.freeze_se:
+        for p in se_net.parameters():
+            p.requires_grad = False
+        optimizer = torch.optim.Adam(te_net.parameters(), lr=lr, weight_decay=weight_decay)
+    else:
+        optimizer = torch.optim.Adam(itertools.chain(te_net.parameters(), se_net.parameters()), lr=lr, weight_decay=weight_decay)
+
+    model_save_path = os.path.splitext(checkpoint_path)[0] + '_heads_{}.pt'.format(time.strftime("%Y_%m_%d_%H_%M_%S", time.localtime()))
+    early_stopping = EarlyStopping(patience=patience, verbose=True, save_path=model_save_path,
+                                   async_save=args.async_checkpoint, keep_top_k=args.keep_top_k)
+    train_sample_idx_generator = index_generator(batch_size=batch_size, num_data=drug_drug_idx['train'].shape[0])
+    train_drug_drug_idx = torch.tensor(drug_drug_idx['train'], dtype=torch.int64).to(device)
+    train_cellline_idx = torch.tensor(cellline_idx['train'], dtype=torch.int64).to(device)
+
+    te_criterion = torch.nn.MSELoss(reduction='mean')
+    se_criterion = torch.nn.BCELoss(reduction='mean')
+
+    for epoch in range(num_epochs):
+        t_start = time.time()
+        se_net.train(not args.freeze_se)
+        te_net.train()
+        for iteration in range(train_sample_idx_generator.num_iterations()):
+            train_sample_idx_batch = torch.from_numpy(train_sample_idx_generator.next()).to(device)
+            train_drug_drug_batch = train_drug_drug_idx[train_sample_idx_batch]
+            row_drug_composite_embedding = drug_composite_table[train_drug_drug_batch[:, 0]]
+            col_drug_composite_embedding = drug_composite_table[train_drug_drug_batch[:, 1]]
+
+            se_output = sigmoid(se_net(row_drug_composite_embedding, col_drug_composite_embedding))
+            if output_concat == True:
+                se_output_ = se_output.clone().detach()
+                te_output = te_net(row_drug_composite_embedding, col_drug_composite_embedding, train_cellline_idx[train_sample_idx_batch], se_output_)
+            else:
+                te_output = te_net(row_drug_composite_embedding, col_drug_composite_embedding, train_cellline_idx[train_sample_idx_batch])
+
+            te_loss = te_criterion(te_output, te_labels['train'][train_sample_idx_batch])
+            se_loss = se_criterion(se_output, se_labels['train'][train_sample_idx_batch])
+            if args.freeze_se:
+                train_total_loss_batch = loss_ratio_te * te_loss
+            else:
+                train_total_loss_batch = loss_ratio_te * te_loss + loss_ratio_se * se_loss
+
+            optimizer.zero_grad()
+            train_total_loss_batch.backward()
+            optimizer.step()
+
+        # val samples are scored in both drug orders, as in HNEMA_evaluation.py
+        val_te_output, val_se_output = score_drug_triples(
+            drug_embedding_table, all_drug_morgan, se_net, te_net, drug_drug_idx['val'], cellline_idx['val'],
+            output_concat, batch_size)
+        val_total_loss = loss_ratio_te * te_criterion(val_te_output, te_labels['val']) + \
+                         loss_ratio_se * se_criterion(val_se_output, se_labels['val'][:])
+        t_end = time.time()
+        print('Epoch {:05d} | Train_Loss {:.4f} | Val_Loss {:.4f} | Time(s) {:.4f}'.format(
+            epoch, train_total_loss_batch.item(), val_total_loss.item(), t_end - t_start))
+
+        # the checkpoint keeps the frozen main_net, so it can be used by HNEMA_evaluation.py as well
+        early_stopping(val_total_loss.item(),
+                       {
+                           'main_net': main_net.state_dict(),
+                           'se_net': se_net.state_dict(),
+                           'te_net': te_net.state_dict()
+                       })
+        if early_stopping.early_stop:
+            print('Early stopping based on the validation loss!')
+            break
+
+    # the last checkpoint has to be on the disk before it is loaded for the test
+    early_stopping.close()
+
+    # model test
+    print('The name of loaded model is:', model_save_path)
+    checkpoint = torch.load(model_save_path, map_location=device)
+    se_net.load_state_dict(checkpoint['se_net'])
+    te_net.load_state_dict(checkpoint['te_net'])
+    test_te_results, test_se_results = score_drug_triples(
+        drug_embedding_table, all_drug_morgan, se_net, te_net, drug_drug_idx['test'], cellline_idx['test'],
+        output_concat, batch_size)
+    test_te_results = test_te_results.cpu().numpy()
+    test_te_label_list = te_labels['test'].cpu().numpy()
+
+    TE_MSE = mean_squared_error(test_te_label_list, test_te_results)
+    TE_RMSE = np.sqrt(TE_MSE)
+    TE_MAE = mean_absolute_error(test_te_label_list, test_te_results)
+    # coefficient and 2-tailed p-value
+    TE_PEARSON = scipy.stats.pearsonr(test_te_label_list.reshape(-1), test_te_results.reshape(-1))
+
+    print('Link Prediction Test (predictors retrained on the frozen drug embeddings)')
+    print('TE_MSE = {}'.format(TE_MSE))
+    print('TE_RMSE = {}'.format(TE_RMSE))
+    print('TE_MAE = {}'.format(TE_MAE))
+    print('TE_PEARSON and p-value = {},{}'.format(TE_PEARSON[0], TE_PEARSON[1]))
+
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser(description='HNEMA TE/SE predictor retraining on the frozen drug embeddings')
+    ap.add_argument('--root-prefix', type=str,
+                    default='./data/data4training_model/',
+                    help='root from which to read the original input files')
+    ap.add_argument('--checkpoint', type=str,
+                    default='./data/data4training_model/checkpoint/checkpoint.pt',
+                    help='the trained model (saved by HNEMA_evaluation.py) whose main_net is frozen')
+    ap.add_argument('--cache-prefix', type=str, default=None,
+                    help='prefix of the drug embedding cache files. Default is the checkpoint path without the extension.')
+    ap.add_argument('--refresh-cache', action='store_true',
+                    help='whether to recompute the drug embedding cache even if its files exist')
+    ap.add_argument('--seed', type=int, default=0,
+                    help='Seed of the metapath neighbors sampled once for every drug when computing the cache. Default is 0.')
+    ap.add_argument('--reset-heads', action='store_true',
+                    help='whether to train the TE/SE predictors from scratch instead of starting from the checkpoint')
+    ap.add_argument('--freeze-se', action='store_true',
+                    help='whether to keep the SE predictor fixed and only retrain the TE predictor')
+    ap.add_argument('--csr-store', action='store_true',
+                    help='whether to read the metapath neighbors/instances from the memory-mapped binary CSR files')
+    ap.add_argument('--sparse-se-labels', action='store_true',
+                    help='whether to keep the side effect labels as sparse rows of positive side effects on the device and densify them per batch')
+    # the main model hyper-parameters need to be the same as the ones of the checkpoint
+    ap.add_argument('--hidden-dim-main', type=int, default=64,
+                    help='Dimension of the node hidden state in the main model. Default is 64.')
+    ap.add_argument('--num-heads-main', type=int, default=8,
+                    help='Number of the attention heads in the main model. Default is 8.')
+    ap.add_argument('--attnvec-dim-main', type=int, default=128,
+                    help='Dimension of the attention vector in the main model. Default is 128.')
+    ap.add_argument('--rnn-type-main', default='bi-gru',
+                    help='Type of the aggregator in the main model (bi-gru, gru, bi-lstm, lstm, mean, transformer or transformer-sdpa). '
+                         'transformer-sdpa computes the same attention as transformer with the fused kernel, but its nn.LayerNorm '
+                         '(biased variance, eps inside the square root) only approximates the LayerNorm of transformer. Default is bi-gru.')
+    ap.add_argument('--transformer-layers', type=int, default=6,
+                    help='Number of encoder blocks of the transformer aggregators. Default is 6.')
+    ap.add_argument('--fused-rnn', action='store_true',
+                    help='whether the main model was trained with the fused rnn of all metapaths')
+    ap.add_argument('--attention-fuse', action='store_true',
+                    help='whether the main model was trained with the self-attention fusion of the metapaths')
+    ap.add_argument('--attn-switch-main', default=True,
+                    help='whether need to consider the feature of the central node when using GAT layer in the main model')
+    ap.add_argument('--rnn-concat-main', default=False,
+                    help='whether need to concat the feature extracted from rnn with the embedding from GAT layer in the main model')
+    ap.add_argument('--samples', type=int, default=100,
+                    help='Number of neighbors sampled for every drug when computing the cache. Default is 100.')
+    ap.add_argument('--epoch', type=int, default=100, help='Number of epochs. Default is 100.')
+    ap.add_argument('--patience', type=int, default=8, help='Patience. Default is 8.')
+    ap.add_argument('--async-checkpoint', action='store_true',
+                    help='whether to write the checkpoints from a cpu snapshot in a background thread instead of blocking the training loop')
+    ap.add_argument('--keep-top-k', type=int, default=1,
+                    help='Number of the best checkpoints kept (the previous ones as checkpoint_..._top2.pt, ...). Default is 1.')
+    ap.add_argument('--batch-size', type=int, default=256, help='Batch size. Default is 256.')
+    ap.add_argument('--hidden-dim-aux', type=int, default=64,
+                    help='Dimension of generated cell line embeddings. Default is 64.')
+    ap.add_argument('--loss-ratio-te', type=float, default=10,
+                    help='The weight percentage of therapeutic effect loss in the total loss')
+    ap.add_argument('--loss-ratio-se', type=float, default=1,
+                    help='The weight percentage of adverse effect loss in the total loss')
+    ap.add_argument('--layer-list', default=[2048, 1024, 512],
+                    help='layer neuron units list for the DNN TE predictor.')
+    ap.add_argument('--pred_in_dropout', type=float, default=0.2,
+                    help='The dropout rate in the DNN TE predictor')
+    ap.add_argument('--pred_out_dropout', type=float, default=0.5,
+                    help='The dropout rate in the DNN TE predictor')
+    ap.add_argument('--output_concat', default=True,
+                    help='Whether put the adverse effect output into therapeutiec effect prediction')
+
+    args = ap.parse_args()
+    finetune_heads_HNEMA_DDI(args.root_prefix, args.checkpoint, args.hidden_dim_main, args.num_heads_main,
+                             args.attnvec_dim_main, args.rnn_type_main, args.attn_switch_main, args.rnn_concat_main,
+                             args.epoch, args.patience, args.batch_size, args.samples, args.hidden_dim_aux,
+                             args.loss_ratio_te, args.loss_ratio_se, args.layer_list, args.pred_in_dropout,
+                             args.pred_out_dropout, args.output_concat, args)
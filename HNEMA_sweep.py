@@ -0,0 +1,123 @@
+# run repeats and hyper-parameter grids of HNEMA_evaluation.py in parallel
+# the data is loaded once by the main process and shared with the worker processes (forked, so copy-on-write),
+# every run (one configuration x one seed) trains and tests one model and the summaries are collected into one table
+# example: python HNEMA_sweep.py --grid loss_ratio_te=1,10 rnn_type_main=bi-gru,gru --seeds 0 1 2 3 4 --num-workers 4
+#          python HNEMA_sweep.py --grid loss_ratio_te=0.5,1 layer_list=2048:1024:512,1024:512 --seeds 0 1
+import os
+import copy
+import argparse
+import itertools
+import multiprocessing
+import torch
+import pandas as pd
+from utils.data import load_HNEMA_DDI_data_te
+from HNEMA_evaluation import build_arg_parser, run_model_HNEMA_DDI_from_args
+
+# the data shared by the forked worker processes
+shared_data = None
+
+
+def parse_bool(value):
+    # the boolean arguments (store_true flags and the arguments with a True/False default) of the grid
+    if value in ['True', 'true', '1']:
+        return True
+    if value in ['False', 'false', '0']:
+        return False
+    raise ValueError('not a boolean value in --grid: {}'.format(value))
+
+
+def parse_int_list(value):
+    # the list arguments of the grid (e.g., layer_list) give their elements separated by ':',
+    # because ',' separates the values of the grid: layer_list=2048:1024:512,1024:512
+    return [int(element) for element in value.split(':')]
+
+
+def parse_grid(grid, parser):
+    # ['loss_ratio_te=1,10', 'rnn_type_main=bi-gru,gru'] -> [{'loss_ratio_te': 1.0, 'rnn_type_main': 'bi-gru'}, ...]
+    # the values are converted like the command line would convert them, by the type of the argument in the parser
+    # (the type of the default value may differ, e.g., --loss-ratio-te has type float but the default 10, or no default)
+    actions = {action.dest: action for action in parser._actions}
+    keys, values_list = [], []
+    for item in grid:
+        key, values = item.split('=', 1)
+        key = key.replace('-', '_')
+        if key not in actions:
+            raise ValueError('unknown argument in --grid: {}'.format(key))
+        action = actions[key]
+        if isinstance(action, argparse._StoreTrueAction) or isinstance(action.default, bool):
+            convert = parse_bool
+        elif isinstance(action.default, list):
+            convert = parse_int_list
+        elif action.type is not None:
+            convert = action.type
+        else:
+            convert = str
+        values = [convert(value) for value in values.split(',')]
+        if action.choices is not None:
+            for value in values:
+                if value not in action.choices:
+                    raise ValueError('invalid value in --grid: {}={} (choose from {})'.format(key, value, action.choices))
+        keys.append(key)
+        values_list.append(values)
+    return [dict(zip(keys, values)) for values in itertools.product(*values_list)]
+
+
+def run_sweep_job(job):
+    run_id, config, seed, base_args, num_threads = job
+    torch.set_num_threads(num_threads)
+    args = copy.deepcopy(base_args)
+    for key, value in config.items():
+        setattr(args, key, value)
+    args.seed = seed
+    args.repeat = 1
+    # every run of the sweep is a single process run
+    args.world_size = 1
+    args.run_name = 'sweep{}_seed{}'.format(run_id, seed)
+    summary = run_model_HNEMA_DDI_from_args(args, shared_data)
+    result = {'run_id': run_id, 'seed': seed}
+    # list values are written as in the grid (e.g., 2048:1024:512) so that the results can be grouped by them
+    result.update({key: ':'.join(str(element) for element in value) if isinstance(value, list) else value
+                   for key, value in config.items()})
+    result.update({'MSE': summary['MSE_mean'], 'RMSE': summary['RMSE_mean'], 'MAE': summary['MAE_mean'],
+                   'PEARSON': summary['PEARSON_mean']})
+    return result
+
+
+if __name__ == '__main__':
+    ap = build_arg_parser()
+    ap.description = 'HNEMA repeats and hyper-parameter grids in parallel'
+    ap.add_argument('--grid', nargs='*', default=[],
+                    help='hyper-parameter grid as name=value1,value2 items (argument names of HNEMA_evaluation.py), all combinations are run. '
+                         'The elements of list values are separated by \':\', e.g., layer_list=2048:1024:512,1024:512')
+    ap.add_argument('--seeds', type=int, nargs='+', default=[0],
+                    help='seeds of the runs of every configuration. Default is 0.')
+    ap.add_argument('--num-workers', type=int, default=2, help='Number of parallel runs. Default is 2.')
+    ap.add_argument('--sweep-output', type=str, default=None,
+                    help='csv file of the results. Default is root-prefix/checkpoint/sweep_results.csv.')
+    args = ap.parse_args()
+    configs = parse_grid(args.grid, ap)
+
+    # loaded once, before the workers are forked (the loader reads the npz archives completely, so no file handle is shared)
+    shared_data = load_HNEMA_DDI_data_te(args.root_prefix, args.csr_store, args.sparse_se_labels)
+
+    num_threads = max(1, os.cpu_count() // args.num_workers)
+    jobs = [(run_id, config, seed, args, num_threads)
+            for run_id, config in enumerate(configs) for seed in args.seeds]
+    print('number of configurations and runs:', len(configs), len(jobs))
+
+    # fork: the workers inherit shared_data without pickling it (cuda is only initialized in the workers)
+    with multiprocessing.get_context('fork').Pool(args.num_workers, maxtasksperchild=1) as pool:
+        results = pool.map(run_sweep_job, jobs, chunksize=1)
+
+    results = pd.DataFrame(results)
+    print('----------------------------------------------------------------')
+    print('Sweep results')
+    print(results.to_string(index=False))
+    # mean and std over the seeds of every configuration
+    group_keys = ['run_id'] + list(configs[0].keys())
+    summary = results.groupby(group_keys)[['MSE', 'RMSE', 'MAE', 'PEARSON']].agg(['mean', 'std'])
+    print(summary.to_string())
+
+    sweep_output = args.sweep_output if args.sweep_output is not None else args.root_prefix + 'checkpoint/sweep_results.csv'
+    results.to_csv(sweep_output, index=False)
+    summary.to_csv(os.path.splitext(sweep_output)[0] + '_summary.csv')
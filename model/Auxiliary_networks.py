@@ -29,6 +29,38 @@ class GIN4drug_struc(nn.Module):
         return dgl.mean_nodes(g, 'h')
 
 
+# ECFP6 fingerprints of all drugs kept as their active bits (COO: drug, bit, value)
+# the fingerprint part of a first layer is computed from the active bits only, so the cost depends on the number of set bits
+# instead of the fingerprint width, and the dense drug x bit matrix is never built
+class drug_fingerprint_bag:
+    def __init__(self, coo_matrix, device):
+        self.num_drug, self.num_bits = coo_matrix.shape
+        self.rows = torch.tensor(coo_matrix.row, dtype=torch.int64).to(device)
+        self.cols = torch.tensor(coo_matrix.col, dtype=torch.int64).to(device)
+        self.values = torch.tensor(coo_matrix.data, dtype=torch.float32).to(device)
+
+    def project(self, weight):
+        # weight: out_dim x num_bits block of a linear layer
+        # returns num_drug x out_dim, equal to the dense fingerprints @ weight.t()
+        table = torch.zeros(weight.shape[0], self.num_drug, dtype=weight.dtype, device=weight.device)
+        table.index_add_(1, self.rows, weight[:, self.cols] * self.values.to(weight.dtype))
+        return table.t()
+
+
+def fingerprint_first_layer(linear, drug_embedding1, drug_embedding2, other_inputs, fingerprint):
+    # the first layer of a predictor whose input is [drug_embedding1, fingerprint1, drug_embedding2, fingerprint2, other_inputs]
+    # the fingerprints are given as (drug_fingerprint_bag, drug_idx1, drug_idx2), the parameters are the same as the dense layer's
+    fingerprint_bag, drug_idx1, drug_idx2 = fingerprint
+    emb_dim = drug_embedding1.shape[1]
+    in_feats = emb_dim + fingerprint_bag.num_bits
+    weight = linear.weight
+    dense_weight = torch.cat([weight[:, :emb_dim], weight[:, in_feats:in_feats + emb_dim], weight[:, 2 * in_feats:]], dim=1)
+    output = F.linear(torch.cat([drug_embedding1, drug_embedding2] + other_inputs, dim=1), dense_weight, linear.bias)
+    output = output + fingerprint_bag.project(weight[:, emb_dim:in_feats])[drug_idx1] + \
+        fingerprint_bag.project(weight[:, in_feats + emb_dim:2 * in_feats])[drug_idx2]
+    return output
+
+
 class side_effect_predictor(nn.Module):
     def __init__(self, in_feats, h_feats, dropout_rate=0.0):
         super(side_effect_predictor, self).__init__()
@@ -38,7 +70,10 @@ class side_effect_predictor(nn.Module):
         else:
             self.dropout = lambda x: x
 
-    def forward(self, drug_embedding1, drug_embedding2):
+    def forward(self, drug_embedding1, drug_embedding2, fingerprint=None):
+        # fingerprint: (drug_fingerprint_bag, drug_idx1, drug_idx2) when the drug embeddings do not contain the fingerprints
+        if fingerprint is not None:
+            return fingerprint_first_layer(self.lin1, self.dropout(drug_embedding1), self.dropout(drug_embedding2), [], fingerprint)
         input = torch.cat([drug_embedding1, drug_embedding2], axis=1)
         se_output = self.lin1(self.dropout(input))
         return se_output
@@ -100,8 +135,15 @@ class therapeutic_effect_DNN_predictor(nn.Module):
                 self.linears.append(torch.nn.ReLU())
                 self.linears.append(nn.Dropout(dropout))
 
-    def forward(self, drug_embedding1, drug_embedding2, cellline_idx, se_output=None):
+    def forward(self, drug_embedding1, drug_embedding2, cellline_idx, se_output=None, fingerprint=None):
         cellline_embedding = self.embedding(cellline_idx)
+        # fingerprint: (drug_fingerprint_bag, drug_idx1, drug_idx2) when the drug embeddings do not contain the fingerprints
+        if fingerprint is not None:
+            other_inputs = [cellline_embedding, se_output] if se_output != None else [cellline_embedding]
+            input = fingerprint_first_layer(self.linears[0], drug_embedding1, drug_embedding2, other_inputs, fingerprint)
+            for layer in self.linears[1:]:
+                input = layer(input)
+            return input
         if se_output != None:
             input = torch.cat((drug_embedding1, drug_embedding2, cellline_embedding, se_output), axis=1)
         else:
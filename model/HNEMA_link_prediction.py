@@ -1,5 +1,6 @@
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 import numpy as np
 from model.base_HNEMA import HNEMA_ctr_ntype_specific, HNEMA_ctr_ntype_specific_transformer
 
@@ -15,22 +16,45 @@ class HNEMA_lp_layer(nn.Module):
                  rnn_type='bi-gru',
                  attn_drop=0.5,
                  attn_switch=False,
-                 rnn_concat=False):
+                 rnn_concat=False,
+                 instance_dedup=False,
+                 fused_rnn=False,
+                 transformer_layers=6,
+                 attention_fuse=False):
         super(HNEMA_lp_layer, self).__init__()
         self.in_dim = in_dim
         self.out_dim = out_dim
         self.num_heads = num_heads
 
         # drug/target specific layers
-        self.drug_layer = HNEMA_ctr_ntype_specific(num_metapaths_list[0],
-                                                   in_dim,
-                                                   num_heads,
-                                                   attn_vec_dim,
-                                                   rnn_type,
-                                                   attn_drop,
-                                                   use_minibatch=True,
-                                                   attn_switch=attn_switch,
-                                                   rnn_concat=rnn_concat)
+        # attention_fuse: the metapath-specific outputs are fused by the self-attention among metapaths (Attention_fuse)
+        # instead of the beta weighted sum
+        if attention_fuse:
+            self.drug_layer = HNEMA_ctr_ntype_specific_transformer(num_metapaths_list[0],
+                                                                   None,
+                                                                   in_dim,
+                                                                   num_heads,
+                                                                   attn_vec_dim,
+                                                                   rnn_type,
+                                                                   attn_drop,
+                                                                   use_minibatch=True,
+                                                                   attn_switch=attn_switch,
+                                                                   rnn_concat=rnn_concat,
+                                                                   instance_dedup=instance_dedup,
+                                                                   transformer_layers=transformer_layers)
+        else:
+            self.drug_layer = HNEMA_ctr_ntype_specific(num_metapaths_list[0],
+                                                       in_dim,
+                                                       num_heads,
+                                                       attn_vec_dim,
+                                                       rnn_type,
+                                                       attn_drop,
+                                                       use_minibatch=True,
+                                                       attn_switch=attn_switch,
+                                                       rnn_concat=rnn_concat,
+                                                       instance_dedup=instance_dedup,
+                                                       fused_rnn=fused_rnn,
+                                                       transformer_layers=transformer_layers)
 
         # note that the actual input dimension should consider the number of heads as multiple head outputs are concatenated together
         if (rnn_concat == True):
@@ -44,7 +68,16 @@ class HNEMA_lp_layer(nn.Module):
         # nn.init.xavier_normal_(self.fc_target.weight, gain=1.414)
 
     def forward(self, inputs):
-        g_lists, features, type_mask, edge_metapath_indices_lists, target_idx_lists = inputs
+        g_lists, features, type_mask, edge_metapath_indices_lists, target_idx_lists, batch_inverse = inputs
+        if batch_inverse is not None:
+            # the drugs of the batch are deduplicated (see parse_minibatch_unique):
+            # every unique drug is encoded once and gathered back for both positions of the drug pairs
+            h_drug, atten_drug = self.drug_layer(
+                (g_lists, features, type_mask, edge_metapath_indices_lists, target_idx_lists))
+            logits_drug = self.fc_drug(h_drug)
+            return [logits_drug[batch_inverse[:, 0]], logits_drug[batch_inverse[:, 1]]], \
+                   [h_drug[batch_inverse[:, 0]], h_drug[batch_inverse[:, 1]]], [atten_drug, atten_drug]
+
         # drug/target specific layers
         h_drug1, atten_drug1 = self.drug_layer(
             (g_lists[0], features, type_mask, edge_metapath_indices_lists[0], target_idx_lists[0]))
@@ -68,10 +101,20 @@ class HNEMA_link_prediction(nn.Module):
                  dropout_rate=0.5,
                  attn_switch=False,
                  rnn_concat=False,
-                 args=None):
+                 args=None,
+                 sparse_projection=False,
+                 instance_dedup=False,
+                 fused_rnn=False,
+                 transformer_layers=6,
+                 attention_fuse=False):
         super(HNEMA_link_prediction, self).__init__()
         self.hidden_dim = hidden_dim
         self.args = args
+        # the input features are one-hot identities, so fc(features) is just the (transposed) weight plus the bias
+        # sparse_projection only materializes the rows of the nodes referenced by the metapath instances of the batch
+        self.sparse_projection = sparse_projection
+        # per node type index arrays of type_mask, computed once
+        self.type_index_cache = None
 
         # node type specific transformation
         self.fc_list = nn.ModuleList([nn.Linear(feats_dim, hidden_dim, bias=True) for feats_dim in feats_dim_list])
@@ -93,22 +136,78 @@ class HNEMA_link_prediction(nn.Module):
                                      rnn_type,
                                      attn_drop=dropout_rate,
                                      attn_switch=attn_switch,
-                                     rnn_concat=rnn_concat)
+                                     rnn_concat=rnn_concat,
+                                     instance_dedup=instance_dedup,
+                                     fused_rnn=fused_rnn,
+                                     transformer_layers=transformer_layers,
+                                     attention_fuse=attention_fuse)
 
     def forward(self, inputs):
-        g_lists, features_list, type_mask, edge_metapath_indices_lists, target_idx_lists = inputs
+        # an optional sixth input batch_inverse is given when the drugs of the batch are deduplicated
+        g_lists, features_list, type_mask, edge_metapath_indices_lists, target_idx_lists = inputs[:5]
+        batch_inverse = inputs[5] if len(inputs) > 5 else None
 
         # node type specific transformation
         # type_mask是药物加上靶点的总个数
-        transformed_features = torch.zeros(type_mask.shape[0], self.hidden_dim, device=features_list[0].device)
-        for i, fc in enumerate(self.fc_list):
-            node_indices = np.where(type_mask == i)[0]
-            transformed_features[node_indices] = fc(features_list[i])
+        node_indices_list, node_local_idx = self.type_indices(type_mask, features_list[0].device)
+        # the projection of the (sparse) one-hot features stays in fp32 under autocast
+        with torch.autocast(device_type=features_list[0].device.type, enabled=False):
+            if self.sparse_projection:
+                transformed_features, edge_metapath_indices_lists = self.project_batch_nodes(
+                    features_list, node_local_idx, edge_metapath_indices_lists)
+            else:
+                transformed_features = torch.zeros(type_mask.shape[0], self.hidden_dim, device=features_list[0].device)
+                for i, fc in enumerate(self.fc_list):
+                    transformed_features[node_indices_list[i]] = fc(features_list[i])
         # create a matrix storing all node features of the dataset
         transformed_features = self.feat_drop(transformed_features)
 
         # hidden layers
         [logits_drug1, logits_drug2], [h_drug1, h_drug2], [atten_drug1, atten_drug2] = self.layer(
-            (g_lists, transformed_features, type_mask, edge_metapath_indices_lists, target_idx_lists))
+            (g_lists, transformed_features, type_mask, edge_metapath_indices_lists, target_idx_lists, batch_inverse))
 
         return [logits_drug1, logits_drug2], [h_drug1, h_drug2], [atten_drug1, atten_drug2]
+
+    def type_indices(self, type_mask, device):
+        # node indices of every type, and (type, index within the type) of every node
+        if self.type_index_cache is None or self.type_index_cache[0] != type_mask.shape[0] \
+                or self.type_index_cache[1] != device:
+            node_indices_list = [np.where(type_mask == i)[0] for i in range(len(self.fc_list))]
+            node_local_idx = np.zeros((type_mask.shape[0], 2), dtype=np.int64)
+            for i, node_indices in enumerate(node_indices_list):
+                node_local_idx[node_indices, 0] = i
+                node_local_idx[node_indices, 1] = np.arange(len(node_indices))
+            self.type_index_cache = (type_mask.shape[0], device, node_indices_list,
+                                     torch.from_numpy(node_local_idx).to(device))
+        return self.type_index_cache[2], self.type_index_cache[3]
+
+    def project_batch_nodes(self, features_list, node_local_idx, edge_metapath_indices_lists):
+        # embedding-style projection of the nodes referenced by the metapath instances of the batch only
+        # returns the projected features of these nodes and the instances relabeled to index them
+        flat_indices = []
+
+        def collect(indices):
+            if torch.is_tensor(indices):
+                flat_indices.append(indices.reshape(-1))
+            else:
+                for item in indices:
+                    collect(item)
+
+        collect(edge_metapath_indices_lists)
+        batch_nodes, inverse = torch.unique(torch.cat(flat_indices), return_inverse=True)
+
+        transformed_features = torch.zeros(batch_nodes.shape[0], self.hidden_dim, device=features_list[0].device)
+        batch_node_types = node_local_idx[batch_nodes, 0]
+        batch_node_local_idx = node_local_idx[batch_nodes, 1]
+        for i, fc in enumerate(self.fc_list):
+            mask = batch_node_types == i
+            transformed_features[mask] = F.embedding(batch_node_local_idx[mask], fc.weight.t()) + fc.bias
+
+        inverse = iter(torch.split(inverse, [indices.numel() for indices in flat_indices]))
+
+        def relabel(indices):
+            if torch.is_tensor(indices):
+                return next(inverse).reshape(indices.shape)
+            return [relabel(item) for item in indices]
+
+        return transformed_features, relabel(edge_metapath_indices_lists)
@@ -14,7 +14,10 @@ class Encoder(nn.Module):
     def __init__(self, layer, N):
         super(Encoder, self).__init__()
         self.layers = clones(layer, N)
-        self.norm = LayerNorm(layer.size)
+        if layer.native_norm:
+            self.norm = nn.LayerNorm(layer.size, eps=1e-6)
+        else:
+            self.norm = LayerNorm(layer.size)
 
     def forward(self, x, mask):
         for layer in self.layers:
@@ -36,10 +39,15 @@ class LayerNorm(nn.Module):
 
 
 class SublayerConnection(nn.Module):
-    def __init__(self, size, dropout):
+    def __init__(self, size, dropout, native_norm=False):
         super(SublayerConnection, self).__init__()
         # temporaily set num_attn head=8
-        self.norm = LayerNorm(size)
+        # native_norm: torch's fused nn.LayerNorm instead of the LayerNorm above. This is an approximation, not the same function:
+        # nn.LayerNorm divides by sqrt(biased variance + eps), the LayerNorm above by (unbiased std + eps)
+        if native_norm:
+            self.norm = nn.LayerNorm(size, eps=1e-6)
+        else:
+            self.norm = LayerNorm(size)
         self.dropout = nn.Dropout(dropout)
         # self.skip_proj = nn.Linear(size, self.num_of_heads * size, bias=False)
 
@@ -49,13 +57,14 @@ class SublayerConnection(nn.Module):
 
 
 class EncoderLayer(nn.Module):
-    def __init__(self, size, self_attn, feed_forward, dropout):
+    def __init__(self, size, self_attn, feed_forward, dropout, native_norm=False):
         # size parameter is obtained from the external output, which is used to make the model the
         super(EncoderLayer, self).__init__()
         self.self_attn = self_attn
         self.feed_forward = feed_forward
-        self.sublayer = clones(SublayerConnection(size, dropout), 2)
+        self.sublayer = clones(SublayerConnection(size, dropout, native_norm), 2)
         self.size = size
+        self.native_norm = native_norm
 
     def forward(self, x, mask):
         x = self.sublayer[0](x, lambda x: self.self_attn(x, x, x, mask))
@@ -103,6 +112,26 @@ class MultiHeadedAttention(nn.Module):
         return self.linears[-1](x)
 
 
+# the same parameters as MultiHeadedAttention, but the attention is computed by the fused scaled_dot_product_attention kernel
+# (the attention probabilities are not kept in self.attn)
+class SDPAMultiHeadedAttention(MultiHeadedAttention):
+    def forward(self, query, key, value, mask=None):
+        if (mask is not None):
+            # Same mask applied to all h heads.
+            mask = mask.unsqueeze(1) != 0
+
+        nbatches = query.size(0)
+
+        query, key, value = [l(x).view(nbatches, -1, self.h, self.d_k).transpose(1, 2)
+                             for l, x in zip(self.linears, (query, key, value))]
+
+        x = F.scaled_dot_product_attention(query, key, value, attn_mask=mask,
+                                           dropout_p=self.dropout.p if self.training else 0.0)
+
+        x = x.transpose(1, 2).contiguous().view(nbatches, -1, self.h * self.d_k)
+        return self.linears[-1](x)
+
+
 class PositionwiseFeedForward(nn.Module):
     def __init__(self, d_model, d_ff, dropout=0.1):
         super(PositionwiseFeedForward, self).__init__()
@@ -4,7 +4,8 @@ import torch.nn.functional as F
 import dgl.function as fn
 from dgl.nn.pytorch import edge_softmax
 import copy
-from model.Trans_encoder import MultiHeadedAttention, PositionwiseFeedForward, Encoder, EncoderLayer
+import math
+from model.Trans_encoder import MultiHeadedAttention, SDPAMultiHeadedAttention, PositionwiseFeedForward, Encoder, EncoderLayer
 
 
 class HNEMA_metapath_specific(nn.Module):
@@ -16,7 +17,10 @@ class HNEMA_metapath_specific(nn.Module):
                  alpha=0.01,
                  use_minibatch=False,
                  attn_switch=False,
-                 rnn_concat=False):
+                 rnn_concat=False,
+                 instance_dedup=False,
+                 shared_rnn=False,
+                 transformer_layers=6):
         super(HNEMA_metapath_specific, self).__init__()
         self.out_dim = out_dim
         self.num_heads = num_heads
@@ -24,10 +28,15 @@ class HNEMA_metapath_specific(nn.Module):
         self.use_minibatch = use_minibatch
         self.attn_switch = attn_switch
         self.rnn_concat = rnn_concat
+        # encode every distinct metapath instance (node sequence) of the batch only once
+        self.instance_dedup = instance_dedup
 
         # rnn-like metapath instance aggregator
         # consider multiple attention heads
-        if rnn_type == 'bi-lstm':
+        if shared_rnn:
+            # the instances are encoded by the fused rnn of HNEMA_ctr_ntype_specific, only the attention is kept here
+            pass
+        elif rnn_type == 'bi-lstm':
             print('current rnn type is:', rnn_type)
             self.rnn = nn.LSTM(out_dim, num_heads * out_dim // 2, bidirectional=True)
         elif rnn_type == 'lstm':
@@ -42,10 +51,17 @@ class HNEMA_metapath_specific(nn.Module):
         elif rnn_type == 'mean':
             self.trans_out1 = nn.Linear(out_dim, num_heads * out_dim, bias=False)
             nn.init.xavier_normal_(self.trans_out1.weight, gain=1.414)
-        elif rnn_type == 'transformer':
+        elif rnn_type in ['transformer', 'transformer-sdpa']:
             c = copy.deepcopy
+            # transformer-sdpa: the attention uses the fused scaled_dot_product_attention kernel and the layer norms are nn.LayerNorm
+            # (the attention is the same as in transformer, the layer norms are not: nn.LayerNorm uses the biased variance
+            # with eps inside the square root, so the outputs of a transformer checkpoint only approximately match)
+            native = rnn_type == 'transformer-sdpa'
             # attn = MultiHeadedAttention(num_heads, out_dim)
-            attn = MultiHeadedAttention(1, out_dim)
+            if native:
+                attn = SDPAMultiHeadedAttention(1, out_dim)
+            else:
+                attn = MultiHeadedAttention(1, out_dim)
 
             # the size of fc equals to the output of multi-attention layer
             # num_heads: 64, out_dim:8, fc_hidden_state, dropout
@@ -55,7 +71,7 @@ class HNEMA_metapath_specific(nn.Module):
 
             # self.skip_proj = nn.Linear(out_dim, num_heads * out_dim, bias=False)
             # the second parameter represents the number of encoder block of transformer extractor
-            self.rnn = Encoder(EncoderLayer(out_dim, c(attn), c(ff), 0.1), 6)
+            self.rnn = Encoder(EncoderLayer(out_dim, c(attn), c(ff), 0.1, native), transformer_layers)
 
             self.trans_out1 = nn.Linear(out_dim, num_heads * out_dim, bias=False)
             self.trans_out2 = nn.Linear(out_dim, num_heads * out_dim, bias=False)
@@ -111,6 +127,28 @@ class HNEMA_metapath_specific(nn.Module):
             g, features, type_mask, edge_metapath_indices, target_idx = inputs
         else:
             g, features, type_mask, edge_metapath_indices = inputs
+            target_idx = None
+
+        # the same instance is sampled for every batch row sharing its drug,
+        # so the sequence encoder runs on the unique instances and the results are gathered back to the edges
+        instance_inverse = None
+        if self.instance_dedup:
+            edge_metapath_indices, instance_inverse = torch.unique(edge_metapath_indices, dim=0, return_inverse=True)
+
+        hidden, target_node_embed = self.encode(features, edge_metapath_indices)
+
+        if instance_inverse is not None:
+            # unique instances -> edges
+            hidden = hidden[:, instance_inverse]
+            if self.attn_switch:
+                target_node_embed = target_node_embed[:, instance_inverse]
+
+        return self.propagate(g, hidden, target_node_embed, target_idx)
+
+    def encode(self, features, edge_metapath_indices):
+        # metapath instance encoder
+        # returns hidden (1 x E x num_heads * out_dim) and the center node embedding (1 x E x num_heads * out_dim, None if unused)
+        target_node_embed = None
 
         # Embedding layer
         # use torch.nn.functional.embedding or torch.embedding here
@@ -182,7 +220,7 @@ class HNEMA_metapath_specific(nn.Module):
                 target_node_embed = target_node_embed.reshape(-1, self.out_dim, self.num_heads).permute(
                     0, 2, 1).reshape(-1, self.num_heads * self.out_dim).unsqueeze(dim=0)
 
-        elif self.rnn_type == 'transformer':
+        elif self.rnn_type in ['transformer', 'transformer-sdpa']:
             output = self.rnn(edata, None)
             target_node_embed = output[:, -1, :]
 
@@ -204,6 +242,10 @@ class HNEMA_metapath_specific(nn.Module):
         #         0, 2, 1).reshape(-1, self.num_heads * self.out_dim).unsqueeze(dim=0)
         #     hidden = source_node_embed
 
+        return hidden, target_node_embed
+
+    def propagate(self, g, hidden, target_node_embed, target_idx=None):
+        # node-level attention over the encoded metapath instances and message passing to the center nodes
         eft = hidden.permute(1, 0, 2).view(-1, self.num_heads, self.out_dim)  # E x num_heads x out_dim
 
         if self.attn_switch:
@@ -217,11 +259,12 @@ class HNEMA_metapath_specific(nn.Module):
             a = (eft * self.attn).sum(dim=-1).unsqueeze(dim=-1)  # E x num_heads x 1
 
         a = self.leaky_relu(a)
-        # switch the device
-        g = g.to(torch.device('cuda:0'))
-        # g = g.to(torch.device('cpu'))
+        # the graphs are built on the model device in parse_minibatch, so normally no transfer happens here
+        if g.device != eft.device:
+            g = g.to(eft.device)
 
-        g.edata.update({'eft': eft, 'a': a})
+        # the edge softmax is computed in fp32, also when the rest runs in reduced precision (autocast)
+        g.edata.update({'eft': eft, 'a': a.float()})
         self.edge_softmax(g)
 
         # compute the aggregated node features scaled by the dropped, unnormalized attention values.
@@ -252,12 +295,43 @@ class HNEMA_ctr_ntype_specific(nn.Module):
                  attn_drop=0.5,
                  use_minibatch=False,
                  attn_switch=False,
-                 rnn_concat=False):
+                 rnn_concat=False,
+                 instance_dedup=False,
+                 fused_rnn=False,
+                 transformer_layers=6):
         super(HNEMA_ctr_ntype_specific, self).__init__()
         self.out_dim = out_dim
         self.num_heads = num_heads
         self.use_minibatch = use_minibatch
         self.rnn_concat = rnn_concat
+        self.rnn_type = rnn_type
+        self.attn_switch = attn_switch
+        self.instance_dedup = instance_dedup
+
+        # keep_metapath_outs: the metapath-specific outputs and the metapath-level attention of the last forward pass
+        # are kept in self.metapath_outs (num_metapaths x N x dim) and self.beta (e.g., for the drug embedding cache)
+        self.keep_metapath_outs = False
+        self.metapath_outs = None
+        self.beta = None
+
+        # fused_rnn: the instances of all metapaths are encoded by one rnn call on a packed sequence,
+        # the metapaths share the rnn and are told apart by a metapath type embedding added to every node of the instance
+        if fused_rnn and rnn_type not in ['bi-lstm', 'lstm', 'bi-gru', 'gru']:
+            print('fused rnn is only available for the gru/lstm aggregators, use the metapath-specific', rnn_type, 'instead')
+            fused_rnn = False
+        self.fused_rnn = fused_rnn
+        if self.fused_rnn:
+            print('current rnn type is: fused', rnn_type)
+            if rnn_type == 'bi-lstm':
+                self.rnn = nn.LSTM(out_dim, num_heads * out_dim // 2, bidirectional=True)
+            elif rnn_type == 'lstm':
+                self.rnn = nn.LSTM(out_dim, num_heads * out_dim)
+            elif rnn_type == 'bi-gru':
+                self.rnn = nn.GRU(out_dim, num_heads * out_dim // 2, bidirectional=True)
+            elif rnn_type == 'gru':
+                self.rnn = nn.GRU(out_dim, num_heads * out_dim)
+            self.metapath_type_embedding = nn.Embedding(num_metapaths, out_dim)
+            nn.init.xavier_normal_(self.metapath_type_embedding.weight, gain=1.414)
 
         # metapath-specific layers
         self.metapath_layers = nn.ModuleList()
@@ -268,7 +342,10 @@ class HNEMA_ctr_ntype_specific(nn.Module):
                                                                 attn_drop=attn_drop,
                                                                 use_minibatch=use_minibatch,
                                                                 attn_switch=attn_switch,
-                                                                rnn_concat=rnn_concat))
+                                                                rnn_concat=rnn_concat,
+                                                                instance_dedup=instance_dedup,
+                                                                shared_rnn=self.fused_rnn,
+                                                                transformer_layers=transformer_layers))
 
         # metapath-level attention
         # note that the actual input dimension should consider the number of heads
@@ -284,8 +361,68 @@ class HNEMA_ctr_ntype_specific(nn.Module):
         nn.init.xavier_normal_(self.fc1.weight, gain=1.414)
         nn.init.xavier_normal_(self.fc2.weight, gain=1.414)
 
+    def fused_encode(self, features, edge_metapath_indices_list):
+        # encode the instances of all metapaths with one packed sequence call of the shared rnn
+        # returns (hidden, target_node_embed) of every metapath, as HNEMA_metapath_specific.encode does
+        if self.instance_dedup:
+            unique_list = [torch.unique(edge_metapath_indices, dim=0, return_inverse=True)
+                           for edge_metapath_indices in edge_metapath_indices_list]
+            edge_metapath_indices_list = [unique for unique, _ in unique_list]
+        num_instances = [edge_metapath_indices.shape[0] for edge_metapath_indices in edge_metapath_indices_list]
+        max_len = max(edge_metapath_indices.shape[1] for edge_metapath_indices in edge_metapath_indices_list)
+
+        # E_total x max_len x out_dim, the instances shorter than max_len are zero-padded at the end
+        edata = features.new_zeros(sum(num_instances), max_len, features.shape[1])
+        lengths = []
+        start = 0
+        for i, edge_metapath_indices in enumerate(edge_metapath_indices_list):
+            end = start + num_instances[i]
+            edata[start:end, :edge_metapath_indices.shape[1]] = F.embedding(edge_metapath_indices, features) + \
+                self.metapath_type_embedding.weight[i]
+            lengths += [edge_metapath_indices.shape[1]] * num_instances[i]
+            start = end
+        lengths = torch.tensor(lengths, dtype=torch.int64)
+
+        packed = nn.utils.rnn.pack_padded_sequence(edata, lengths, batch_first=True, enforce_sorted=False)
+        if self.rnn_type in ['bi-lstm', 'lstm']:
+            output, (hidden, _) = self.rnn(packed)
+        else:
+            output, hidden = self.rnn(packed)
+        output, _ = nn.utils.rnn.pad_packed_sequence(output, batch_first=True, total_length=max_len)
+        # output of the last node (the center node) of every instance
+        target_node_embed = output[torch.arange(output.shape[0], device=output.device), lengths.to(output.device) - 1]
+        target_node_embed = target_node_embed.reshape(-1, self.out_dim, self.num_heads).permute(
+            0, 2, 1).reshape(-1, self.num_heads * self.out_dim).unsqueeze(dim=0)
+        if self.rnn_type in ['bi-lstm', 'bi-gru']:
+            hidden = hidden.permute(1, 0, 2).reshape(-1, self.out_dim, self.num_heads).permute(
+                0, 2, 1).reshape(-1, self.num_heads * self.out_dim).unsqueeze(dim=0)
+
+        encoded = []
+        for i, (hidden_i, target_node_embed_i) in enumerate(
+                zip(torch.split(hidden, num_instances, dim=1), torch.split(target_node_embed, num_instances, dim=1))):
+            if self.instance_dedup:
+                # unique instances -> edges
+                hidden_i = hidden_i[:, unique_list[i][1]]
+                target_node_embed_i = target_node_embed_i[:, unique_list[i][1]]
+            encoded.append((hidden_i, target_node_embed_i))
+        return encoded
+
     def forward(self, inputs):
-        if self.use_minibatch:
+        if self.fused_rnn:
+            if self.use_minibatch:
+                g_list, features, type_mask, edge_metapath_indices_list, target_idx_list = inputs
+            else:
+                g_list, features, type_mask, edge_metapath_indices_list = inputs
+                target_idx_list = [None] * len(g_list)
+
+            # metapath-specific attention on the instances encoded by the fused rnn
+            metapath_outs = [
+                F.elu(metapath_layer.propagate(g, hidden, target_node_embed, target_idx).view(
+                    -1, self.num_heads * self.out_dim * (2 if self.rnn_concat == True else 1)))
+                for g, (hidden, target_node_embed), target_idx, metapath_layer in
+                zip(g_list, self.fused_encode(features, edge_metapath_indices_list), target_idx_list, self.metapath_layers)]
+
+        elif self.use_minibatch:
             g_list, features, type_mask, edge_metapath_indices_list, target_idx_list = inputs
 
             # metapath-specific layers
@@ -330,6 +467,8 @@ class HNEMA_ctr_ntype_specific(nn.Module):
         metapath_outs = torch.cat(metapath_outs, dim=0)
 
         h = torch.sum(beta * metapath_outs, dim=0)
+        if self.keep_metapath_outs:
+            self.metapath_outs, self.beta = metapath_outs.detach(), beta.detach()
         return h, beta
 
 
@@ -344,24 +483,34 @@ class HNEMA_ctr_ntype_specific_transformer(nn.Module):
                  attn_drop=0.5,
                  use_minibatch=False,
                  attn_switch=False,
-                 rnn_concat=False):
+                 rnn_concat=False,
+                 instance_dedup=False,
+                 transformer_layers=6):
         super(HNEMA_ctr_ntype_specific_transformer, self).__init__()
         self.out_dim = out_dim
         self.num_heads = num_heads
         self.use_minibatch = use_minibatch
         self.rnn_concat = rnn_concat
 
+        # keep_metapath_outs: the metapath-specific outputs and the metapath-level attention of the last forward pass
+        # are kept in self.metapath_outs (num_metapaths x N x dim) and self.beta (e.g., for the drug embedding cache)
+        self.keep_metapath_outs = False
+        self.metapath_outs = None
+        self.beta = None
+
         # metapath-specific layers
+        # etypes_list is not used, the metapath-specific layers do not depend on the edge types
         self.metapath_layers = nn.ModuleList()
         for i in range(num_metapaths):
-            self.metapath_layers.append(HNEMA_metapath_specific(etypes_list[i],
-                                                                out_dim,
+            self.metapath_layers.append(HNEMA_metapath_specific(out_dim,
                                                                 num_heads,
                                                                 rnn_type,
                                                                 attn_drop=attn_drop,
                                                                 use_minibatch=use_minibatch,
                                                                 attn_switch=attn_switch,
-                                                                rnn_concat=rnn_concat))
+                                                                rnn_concat=rnn_concat,
+                                                                instance_dedup=instance_dedup,
+                                                                transformer_layers=transformer_layers))
 
         # metapath-level attention
         # note that the acutal input dimension should consider the number of heads
@@ -407,11 +556,15 @@ class HNEMA_ctr_ntype_specific_transformer(nn.Module):
                 for g, edge_metapath_indices, metapath_layer in
                 zip(g_list, edge_metapath_indices_list, self.metapath_layers)]
 
-        metapath_outs = torch.tensor([item.cpu().detach().numpy() for item in metapath_outs]).cuda()
+        # num_metapaths x N x dim, stacked on the device so that the gradients flow back to the metapath-specific layers
+        metapath_outs = torch.stack(metapath_outs, dim=0)
         # add non-linearity to fusing node features of different view
         # Q = metapath_outs, K = metapath_outs, V = metapath_outs
         h = self.metapath_fuse(metapath_outs, metapath_outs, metapath_outs)
-        return h
+        if self.keep_metapath_outs:
+            self.metapath_outs, self.beta = metapath_outs.detach(), self.metapath_fuse.attn.detach()
+        # the metapath-level attention (num_metapaths x num_metapaths) takes the place of beta
+        return h, self.metapath_fuse.attn
 
 
 def clones(module, N):
@@ -422,6 +575,7 @@ class Attention_fuse(nn.Module):
     def __init__(self, dim_model, attn_vec_dim):
         super(Attention_fuse, self).__init__()
         self.linears = clones(nn.Linear(dim_model, attn_vec_dim), 2)
+        self.attn = None
 
         for linear in self.linears:
             nn.init.xavier_normal_(linear.weight, gain=1.414)
@@ -430,14 +584,19 @@ class Attention_fuse(nn.Module):
         metapath_num = query.size(0)
         feature_dim = query.size(-1)
         # flatten the sequence dim of query and key
-        query, key = [l(x) for l, x in zip(self.linears, (query, key))]
+        if query is key:
+            # self-attention: both projections in one matmul
+            query, key = F.linear(query, torch.cat([l.weight for l in self.linears], dim=0),
+                                  torch.cat([l.bias for l in self.linears], dim=0)).chunk(2, dim=-1)
+        else:
+            query, key = [l(x) for l, x in zip(self.linears, (query, key))]
         query = query.reshape(metapath_num, -1)
         key = key.reshape(metapath_num, -1)
         value = value.reshape(metapath_num, -1)
         attention = torch.mm(query, torch.t(key))
-        d_k = torch.tensor(key.size(-1), dtype=torch.float32)
-        attention = torch.div(attention, torch.sqrt(d_k))
+        attention = attention / math.sqrt(key.size(-1))
         attention = F.softmax(attention, dim=-1)
+        self.attn = attention
         output = torch.matmul(attention, value).reshape(metapath_num, -1, feature_dim)
         output = torch.mean(output, dim=0)
         # print(attention)
@@ -0,0 +1,161 @@
+# the metapath neighbor sampling of utils/tools.py: the binary CSR path against the text adjlist path,
+# the packed-key exclusion against the list search of the original parse_adjlist, and the sampling distribution
+# run from the repository root: python -m pytest tests
+import itertools
+import numpy as np
+import pytest
+from utils.data import MetapathCSR
+from utils.tools import exclusion_mask, sample_metapath_csr, parse_adjlist, parse_adjlist_csr
+
+NUM_ROWS, OFFSET, METAPATH_LEN = 12, 20, 4
+
+
+def make_metapath(seed=0):
+    # the .adjlist lines and the _idx arrays of a metapath with repeated neighbors and a row without any neighbor
+    # (the instances hold absolute indices, the nodes at the positions 1 and -2 are shifted by OFFSET)
+    prng = np.random.RandomState(seed)
+    adjlist, idx = [], {}
+    for row in range(NUM_ROWS):
+        degree = 0 if row == 5 else prng.randint(1, 15)
+        neighbors = np.sort(prng.randint(NUM_ROWS, size=degree))
+        instances = np.zeros((degree, METAPATH_LEN), dtype=np.int64)
+        instances[:, 0] = neighbors
+        instances[:, 1] = prng.randint(OFFSET, OFFSET + 6, size=degree)
+        instances[:, -2] = prng.randint(OFFSET, OFFSET + 6, size=degree)
+        instances[:, -1] = row
+        adjlist.append(' '.join(str(node) for node in [row] + list(neighbors)))
+        idx[row] = instances
+    return adjlist, idx
+
+
+def make_exclude(idx, seed=1):
+    # batch drug pairs, some of them occurring at the ends of the instances in both modes
+    prng = np.random.RandomState(seed)
+    instances = np.vstack([idx[row] for row in range(NUM_ROWS)])
+    picked = instances[prng.choice(len(instances), 6, replace=False)]
+    exclude = [[u, a - OFFSET] for u, a in picked[:3][:, [0, 1]]] + [[u, a - OFFSET] for u, a in picked[3:][:, [-1, -2]]]
+    # mode 1 reads the pairs from the positions (1, 0) and (-2, -1)
+    exclude += [[u, a - OFFSET] for a, u in picked[:3][:, [0, 1]]] + [[u, a - OFFSET] for a, u in picked[3:][:, [-1, -2]]]
+    return exclude + [[0, 0], [3, 2]]
+
+
+def reference_exclusion_mask(indices, exclude, offset, mode):
+    # the list search of the original parse_adjlist
+    if mode == 0:
+        return np.array([False if [u1, a1 - offset] in exclude or [u2, a2 - offset] in exclude else True for
+                         u1, a1, u2, a2 in indices[:, [0, 1, -1, -2]]], dtype=bool)
+    return np.array([False if [u1, a1 - offset] in exclude or [u2, a2 - offset] in exclude else True for
+                     a1, u1, a2, u2 in indices[:, [0, 1, -1, -2]]], dtype=bool)
+
+
+def reference_parse_adjlist(adjlist, edge_metapath_indices, exclude=None, offset=None, mode=None):
+    # the original parse_adjlist without sampling (the edges in the order of the rows and of their instances)
+    edges, nodes, result_indices = [], set(), []
+    for row, indices in zip(adjlist, edge_metapath_indices):
+        row_parsed = list(map(int, row.split(' ')))
+        nodes.add(row_parsed[0])
+        if len(row_parsed) > 1:
+            if exclude is not None:
+                mask = reference_exclusion_mask(indices, exclude, offset, mode)
+                neighbors = np.array(row_parsed[1:])[mask]
+                result_indices.append(indices[mask])
+            else:
+                neighbors = row_parsed[1:]
+                result_indices.append(indices)
+        else:
+            neighbors = [row_parsed[0]]
+            indices = np.array([[row_parsed[0]] * indices.shape[1]])
+            if mode == 1:
+                indices += offset
+            result_indices.append(indices)
+        for dst in neighbors:
+            nodes.add(dst)
+            edges.append((row_parsed[0], dst))
+    mapping = {map_from: map_to for map_to, map_from in enumerate(sorted(nodes))}
+    edges = [(mapping[u], mapping[v]) for u, v in edges]
+    return np.array(edges, dtype=np.int64).reshape(-1, 2), np.vstack(result_indices), len(nodes), sorted(nodes)
+
+
+@pytest.mark.parametrize('mode', [0, 1])
+def test_exclusion_mask_matches_list_search(mode):
+    adjlist, idx = make_metapath()
+    exclude = make_exclude(idx)
+    instances = np.vstack([idx[row] for row in range(NUM_ROWS)])
+    mask = exclusion_mask(instances, exclude, OFFSET, mode)
+    np.testing.assert_array_equal(mask, reference_exclusion_mask(instances, exclude, OFFSET, mode))
+    # the batch pairs occur in the instances, so some of them are excluded
+    assert 0 < mask.sum() < len(mask)
+
+
+@pytest.mark.parametrize('mode', [None, 0, 1])
+def test_parse_adjlist_matches_original(mode):
+    adjlist, idx = make_metapath()
+    rows = [7, 5, 0, 11, 3]
+    exclude = make_exclude(idx) if mode is not None else None
+    offset = OFFSET if mode is not None else None
+    edges, indices, num_nodes, mapping = parse_adjlist(
+        [adjlist[row] for row in rows], [idx[row] for row in rows], None, exclude, offset, mode)
+    ref_edges, ref_indices, ref_num_nodes, ref_mapping = reference_parse_adjlist(
+        [adjlist[row] for row in rows], [idx[row] for row in rows], exclude, offset, mode)
+    np.testing.assert_array_equal(edges, ref_edges)
+    np.testing.assert_array_equal(indices, ref_indices)
+    assert num_nodes == ref_num_nodes
+    np.testing.assert_array_equal(mapping, ref_mapping)
+
+
+@pytest.mark.parametrize('mode', [None, 0, 1])
+@pytest.mark.parametrize('samples', [None, 3])
+def test_parse_adjlist_csr_matches_parse_adjlist(mode, samples):
+    adjlist, idx = make_metapath()
+    csr = MetapathCSR.from_adjlist(adjlist, idx)
+    rows = np.array([7, 5, 0, 11, 3, 7])
+    exclude = make_exclude(idx) if mode is not None else None
+    offset = OFFSET if mode is not None else None
+    # the same random state gives the same samples in both paths
+    result = parse_adjlist([adjlist[row] for row in rows], [idx[row] for row in rows], samples, exclude, offset, mode,
+                           np.random.RandomState(4))
+    result_csr = parse_adjlist_csr(csr, rows, samples, exclude, offset, mode, np.random.RandomState(4))
+    for value, value_csr in zip(result, result_csr):
+        np.testing.assert_array_equal(value, value_csr)
+
+
+def inclusion_probabilities(weights, samples):
+    # exact inclusion probability of every item of np.random.choice(len(weights), samples, replace=False, p=weights)
+    # (successive draws proportional to the weights of the remaining items)
+    probabilities = np.zeros(len(weights))
+    for draw in itertools.permutations(range(len(weights)), samples):
+        remaining, p = weights.sum(), 1.0
+        for item in draw:
+            p *= weights[item] / remaining
+            remaining -= weights[item]
+        probabilities[list(draw)] += p
+    return probabilities
+
+
+def test_sample_metapath_csr_distribution():
+    # the frequent neighbors are undersampled: an instance whose neighbor occurs count times in its row has the weight
+    # count ** (3 / 4) / count, and min(samples, degree) instances are drawn without replacement per row
+    neighbors = np.array([0, 1, 2, 2, 3, 3, 3, 3, 4, 5, 6, 6, 6])
+    offsets = np.array([0, 8, 8, 13])
+    csr = MetapathCSR(offsets, neighbors, np.zeros((len(neighbors), 2), dtype=np.int64))
+    rows, samples, num_trials = np.array([0, 1, 2]), 3, 20000
+
+    rng = np.random.RandomState(0)
+    frequencies = np.zeros(len(neighbors))
+    for _ in range(num_trials):
+        seg, inst_idx = sample_metapath_csr(csr, rows, samples, rng)
+        # min(samples, degree) instances of every row, in the original instance order and without repetition
+        np.testing.assert_array_equal(np.bincount(seg, minlength=3), [3, 0, 3])
+        assert np.all(np.diff(inst_idx) > 0)
+        frequencies[inst_idx] += 1
+    frequencies /= num_trials
+
+    for start, end in [(0, 8), (8, 13)]:
+        counts = np.unique(neighbors[start:end], return_counts=True)[1]
+        weights = np.repeat(counts ** (3 / 4) / counts, counts)
+        expected = inclusion_probabilities(weights, samples)
+        np.testing.assert_allclose(frequencies[start:end], expected, atol=0.015)
+
+    # rows with at most samples instances keep all of them
+    seg, inst_idx = sample_metapath_csr(csr, rows, 100, rng)
+    np.testing.assert_array_equal(inst_idx, np.arange(len(neighbors)))
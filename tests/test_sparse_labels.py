@@ -0,0 +1,106 @@
+# the sparse side effect labels (--sparse-se-labels) give the same batch targets as the dense labels
+# and the side effect labels of the dataset builder (pair-key join) match the search of every sample in twosides
+# run from the repository root: python -m pytest tests
+import numpy as np
+import pandas as pd
+import pytest
+import scipy.sparse
+import torch
+from torch.testing import assert_close
+from utils.tools import sparse_label_matrix, multilabel_targets
+from HNEMA_dataset_builder import te_label_columns, build_samples_and_labels
+
+NUM_SAMPLES, NUM_SE = 60, 25
+
+
+def make_labels(seed=0):
+    labels = (np.random.RandomState(seed).rand(NUM_SAMPLES, NUM_SE) < 0.2).astype('float32')
+    # samples without any positive side effect
+    labels[[3, 17, 42]] = 0
+    return labels
+
+
+def get_devices():
+    return ['cpu', 'cuda'] if torch.cuda.is_available() else ['cpu']
+
+
+@pytest.mark.parametrize('device', get_devices())
+def test_sparse_label_matrix_matches_dense(device):
+    labels = make_labels()
+    device = torch.device(device)
+    dense = multilabel_targets(labels, device)
+    sparse = multilabel_targets(scipy.sparse.csr_matrix(labels), device, sparse=True)
+    assert isinstance(sparse, sparse_label_matrix)
+    assert len(sparse) == NUM_SAMPLES
+
+    batch = np.random.RandomState(1).permutation(NUM_SAMPLES)[:16]
+    assert_close(sparse[batch], dense[batch])
+    assert_close(sparse[list(batch)], dense[batch])
+    assert_close(sparse[:], dense)
+    assert_close(sparse[10:20], dense[10:20])
+    # repeated rows and an empty batch
+    assert_close(sparse[[3, 3, 5]], dense[[3, 3, 5]])
+    assert sparse[np.zeros(0, dtype=np.int64)].shape == (0, NUM_SE)
+
+
+@pytest.mark.parametrize('device', get_devices())
+def test_sparse_label_matrix_tensor_index(device):
+    # the training loops index the labels with sample index batches that are already on the device
+    labels = make_labels()
+    device = torch.device(device)
+    dense = multilabel_targets(labels, device)
+    sparse = multilabel_targets(labels, device, sparse=True)
+    batch = torch.from_numpy(np.random.RandomState(2).permutation(NUM_SAMPLES)[:16]).to(device)
+    assert_close(sparse[batch], dense[batch])
+    # an index tensor on the cpu is moved to the device of the labels
+    assert_close(sparse[batch.cpu()], dense[batch])
+    assert_close(sparse[batch.int()], dense[batch])
+
+
+def make_builder_inputs(seed=0, num_drug=8):
+    prng = np.random.RandomState(seed)
+    drug2id_dict = {'drug{}'.format(i): i for i in range(num_drug)}
+    # side effects of some drug pairs, in both drug orders and with duplicated rows
+    pairs = prng.randint(num_drug, size=(40, 2))
+    twosides_sorted = pd.DataFrame({'drug1_lower': ['drug{}'.format(i) for i in pairs[:, 0]],
+                                    'drug2_lower': ['drug{}'.format(i) for i in pairs[:, 1]],
+                                    'Polypharmacy Side Effect': ['C{:03d}'.format(i) for i in prng.randint(10, size=40)]})
+    twosides_sorted = pd.concat([twosides_sorted, twosides_sorted.iloc[:5]], ignore_index=True)
+    drugcomb_split = []
+    for num_samples in [30, 10, 10]:
+        drugcomb = pd.DataFrame({'drugid1': prng.randint(num_drug, size=num_samples),
+                                 'drugid2': prng.randint(num_drug, size=num_samples),
+                                 'cell_line_name': prng.choice(['A', 'B', 'C'], size=num_samples)})
+        for column in te_label_columns:
+            drugcomb[column] = prng.randn(num_samples)
+        drugcomb_split.append(drugcomb)
+    return drugcomb_split, twosides_sorted, drug2id_dict
+
+
+def test_builder_se_labels_match_pair_search(tmp_path):
+    # the pair-key join of the builder against the search of the side effects of every sample (as in the notebook)
+    drugcomb_split, twosides_sorted, drug2id_dict = make_builder_inputs()
+    prefix = str(tmp_path) + '/'
+    build_samples_and_labels(prefix, drugcomb_split, twosides_sorted, drug2id_dict, dense_se_labels=True)
+    samples = np.load(prefix + 'train_val_test_drug_drug_samples.npz')
+    labels = np.load(prefix + 'train_val_test_drug_drug_labels.npz')
+    se_symbols = sorted(set(twosides_sorted['Polypharmacy Side Effect']))
+
+    for phase in ['train', 'val', 'test']:
+        drug_pairs = samples[phase + '_drug_drug_samples'][:, :2].astype(int)
+        reference = np.zeros((len(drug_pairs), len(se_symbols)), dtype='float32')
+        for i, (drug1, drug2) in enumerate(drug_pairs):
+            for _, row in twosides_sorted.iterrows():
+                if {drug2id_dict[row['drug1_lower']], drug2id_dict[row['drug2_lower']]} == {drug1, drug2}:
+                    reference[i, se_symbols.index(row['Polypharmacy Side Effect'])] = 1
+        se_labels = scipy.sparse.load_npz(prefix + phase + '_se_labels.npz')
+        np.testing.assert_array_equal(se_labels.toarray(), reference)
+        np.testing.assert_array_equal(labels[phase + '_se_labels'], reference)
+        assert reference.sum() > 0
+
+        # the sparse labels on the device give the same batches as the dense labels
+        dense = multilabel_targets(labels[phase + '_se_labels'], torch.device('cpu'))
+        sparse = multilabel_targets(se_labels, torch.device('cpu'), sparse=True)
+        batch = torch.from_numpy(np.random.RandomState(3).permutation(len(drug_pairs))[:7])
+        assert_close(sparse[batch], dense[batch])
+        assert_close(sparse[:], dense)
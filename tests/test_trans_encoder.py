@@ -0,0 +1,103 @@
+# parity of the transformer-sdpa building blocks (fused attention kernel, nn.LayerNorm) with the original transformer blocks
+# run from the repository root: python -m pytest tests
+import copy
+import math
+import pytest
+import torch
+from torch.testing import assert_close
+from model.Trans_encoder import MultiHeadedAttention, SDPAMultiHeadedAttention, PositionwiseFeedForward, Encoder, \
+    EncoderLayer, LayerNorm
+
+# the aggregators encode metapath instances of length 2 to 5
+SIZE, D_FF, BATCH, SEQ_LEN = 8, 16, 32, 5
+
+
+def make_encoder_layer(attn_class, native_norm):
+    attn = attn_class(1, SIZE)
+    ff = PositionwiseFeedForward(SIZE, D_FF, 0.1)
+    return EncoderLayer(SIZE, copy.deepcopy(attn), copy.deepcopy(ff), 0.1, native_norm)
+
+
+def copy_weights(source, target, norm_scale=1.0):
+    # the attention and feed forward parameters have the same names in both versions,
+    # the parameters of LayerNorm (a_2, b_2) become the weight and bias of nn.LayerNorm when the target uses native_norm
+    target_keys = target.state_dict().keys()
+    state = {}
+    for key, value in source.state_dict().items():
+        if key.endswith('norm.a_2') and key not in target_keys:
+            state[key[:-len('a_2')] + 'weight'] = value * norm_scale
+        elif key.endswith('norm.b_2') and key not in target_keys:
+            state[key[:-len('b_2')] + 'bias'] = value
+        else:
+            state[key] = value
+    target.load_state_dict(state)
+
+
+def make_mask(seed):
+    # every sequence keeps at least its first position
+    mask = torch.rand(BATCH, 1, SEQ_LEN, generator=torch.Generator().manual_seed(seed)) > 0.3
+    mask[:, :, 0] = True
+    return mask
+
+
+@pytest.mark.parametrize('use_mask', [False, True])
+def test_sdpa_attention_matches_attention(use_mask):
+    torch.manual_seed(0)
+    reference = MultiHeadedAttention(2, SIZE).eval()
+    sdpa = SDPAMultiHeadedAttention(2, SIZE).eval()
+    sdpa.load_state_dict(reference.state_dict())
+    x = torch.randn(BATCH, SEQ_LEN, 2 * SIZE)
+    mask = make_mask(1) if use_mask else None
+    with torch.no_grad():
+        assert_close(sdpa(x, x, x, mask), reference(x, x, x, mask))
+
+
+def test_sdpa_encoder_layer_matches_encoder_layer():
+    # with the original LayerNorm the sdpa encoder is the same function as the original encoder
+    torch.manual_seed(0)
+    reference = Encoder(make_encoder_layer(MultiHeadedAttention, False), 2).eval()
+    sdpa = Encoder(make_encoder_layer(SDPAMultiHeadedAttention, False), 2).eval()
+    copy_weights(reference, sdpa)
+    x = torch.randn(BATCH, SEQ_LEN, SIZE)
+    mask = make_mask(2)
+    with torch.no_grad():
+        assert_close(sdpa(x, mask), reference(x, mask))
+
+
+def test_native_norm_is_an_approximation():
+    # native_norm is NOT numerically identical to LayerNorm:
+    # LayerNorm computes a_2 * (x - mean) / (std + eps) with the unbiased std,
+    # nn.LayerNorm computes weight * (x - mean) / sqrt(var + eps) with the biased variance
+    torch.manual_seed(0)
+    reference = LayerNorm(SIZE)
+    native = torch.nn.LayerNorm(SIZE, eps=1e-6)
+    with torch.no_grad():
+        reference.a_2.normal_()
+        reference.b_2.normal_()
+    x = torch.randn(BATCH, SEQ_LEN, SIZE)
+    native.load_state_dict({'weight': reference.a_2.detach(), 'bias': reference.b_2.detach()})
+
+    with torch.no_grad():
+        assert not torch.allclose(native(x), reference(x), rtol=1e-3, atol=1e-3)
+        # scaling the weight by sqrt((n - 1) / n) accounts for the biased variance,
+        # the remaining difference comes from where eps is added and is small for inputs that are not constant
+        native.weight.mul_(math.sqrt((SIZE - 1) / SIZE))
+        assert_close(native(x), reference(x), rtol=1e-4, atol=1e-4)
+
+
+def test_native_norm_encoder_layer_is_close_to_encoder_layer():
+    # the full transformer-sdpa block (fused attention and nn.LayerNorm) only matches the original block
+    # after the weights of the layer norms are rescaled for the biased variance, see above
+    torch.manual_seed(0)
+    reference = Encoder(make_encoder_layer(MultiHeadedAttention, False), 2).eval()
+    sdpa = Encoder(make_encoder_layer(SDPAMultiHeadedAttention, True), 2).eval()
+    x = torch.randn(BATCH, SEQ_LEN, SIZE)
+    mask = make_mask(3)
+
+    copy_weights(reference, sdpa)
+    with torch.no_grad():
+        assert not torch.allclose(sdpa(x, mask), reference(x, mask), rtol=1e-3, atol=1e-3)
+
+    copy_weights(reference, sdpa, norm_scale=math.sqrt((SIZE - 1) / SIZE))
+    with torch.no_grad():
+        assert_close(sdpa(x, mask), reference(x, mask), rtol=1e-4, atol=1e-4)
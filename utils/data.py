@@ -1,3 +1,4 @@
+import os
 import numpy as np
 import scipy
 import pickle
@@ -6,10 +7,115 @@ from dgl.data import DGLDataset
 import torch
 import dgl
 
+# the drug metapaths stored under '<prefix>0/', following the order of involved_metapaths
+HNEMA_metapath_names = ['0-1-0', '0-1-1-0', '0-1-1-1-0', '0-te-0']
 
-def load_HNEMA_DDI_data_te(prefix='D:/B/PROJECT B2_2/dataset/generated_2/after_process/'):
-    print('the path of source file is :', prefix)
 
+class MetapathCSR:
+    # binary, CSR-style store of the metapath neighbors and instances of every central node
+    # offsets: (N + 1,) int64, the neighbors/instances of node i are in [offsets[i], offsets[i + 1])
+    # neighbors: (E,) int32, relative index of the metapath neighbor (the same as in the .adjlist files)
+    # instances: (E, L) int32, absolute indices of the metapath instance with the central node in the last position
+    # (the same as the arrays in the _idx.pickle files)
+    def __init__(self, offsets, neighbors, instances):
+        self.offsets = offsets
+        self.neighbors = neighbors
+        self.instances = instances
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    @property
+    def metapath_len(self):
+        return self.instances.shape[1]
+
+    def degrees(self, rows):
+        rows = np.asarray(rows)
+        return self.offsets[rows + 1] - self.offsets[rows]
+
+    def neighbors_of(self, row):
+        return self.neighbors[self.offsets[row]:self.offsets[row + 1]]
+
+    def instances_of(self, row):
+        return self.instances[self.offsets[row]:self.offsets[row + 1]]
+
+    def save(self, path_prefix):
+        np.save(path_prefix + '_offsets.npy', np.asarray(self.offsets))
+        np.save(path_prefix + '_neighbors.npy', np.asarray(self.neighbors))
+        np.save(path_prefix + '_instances.npy', np.asarray(self.instances))
+
+    @classmethod
+    def exists(cls, path_prefix):
+        return all(os.path.exists(path_prefix + suffix) for suffix in
+                   ['_offsets.npy', '_neighbors.npy', '_instances.npy'])
+
+    @classmethod
+    def load(cls, path_prefix, mmap_mode='r'):
+        # the offsets are small and accessed on every minibatch, so they are always read into memory
+        offsets = np.load(path_prefix + '_offsets.npy')
+        neighbors = np.load(path_prefix + '_neighbors.npy', mmap_mode=mmap_mode)
+        instances = np.load(path_prefix + '_instances.npy', mmap_mode=mmap_mode)
+        return cls(offsets, neighbors, instances)
+
+    @classmethod
+    def from_adjlist(cls, adjlist, idx, path_prefix=None):
+        # adjlist: the lines of a .adjlist file, idx: the dict loaded from the corresponding _idx.pickle file
+        # if path_prefix is given, the instance array is written into a .npy file directly instead of into memory
+        num_rows = len(adjlist)
+        degrees = np.array([idx[row].shape[0] for row in range(num_rows)], dtype=np.int64)
+        offsets = np.zeros(num_rows + 1, dtype=np.int64)
+        np.cumsum(degrees, out=offsets[1:])
+        num_instances = int(offsets[-1])
+        metapath_len = idx[0].shape[1]
+
+        if path_prefix is not None:
+            np.save(path_prefix + '_offsets.npy', offsets)
+            neighbors = np.lib.format.open_memmap(path_prefix + '_neighbors.npy', mode='w+', dtype=np.int32,
+                                                  shape=(num_instances,))
+            instances = np.lib.format.open_memmap(path_prefix + '_instances.npy', mode='w+', dtype=np.int32,
+                                                  shape=(num_instances, metapath_len))
+        else:
+            neighbors = np.zeros(num_instances, dtype=np.int32)
+            instances = np.zeros((num_instances, metapath_len), dtype=np.int32)
+
+        for row, line in enumerate(adjlist):
+            row_parsed = np.array(line.split(' '), dtype=np.int64)
+            assert row_parsed[0] == row, 'the rows of the adjlist should be ordered by the central node'
+            assert len(row_parsed) - 1 == degrees[row], 'the adjlist and the idx do not match for row {}'.format(row)
+            neighbors[offsets[row]:offsets[row + 1]] = row_parsed[1:]
+            instances[offsets[row]:offsets[row + 1]] = idx[row]
+
+        if path_prefix is not None:
+            neighbors.flush()
+            instances.flush()
+            del neighbors, instances
+            return cls.load(path_prefix)
+        return cls(offsets, neighbors, instances)
+
+
+def convert_HNEMA_metapath_to_csr(prefix, metapath_names=HNEMA_metapath_names):
+    # convert the text .adjlist and pickled _idx files of every metapath into the binary MetapathCSR files
+    for metapath_name in metapath_names:
+        print('converting metapath {} into the binary CSR format'.format(metapath_name))
+        in_file = open(prefix + '0/' + metapath_name + '.adjlist', 'r')
+        adjlist = [line.strip() for line in in_file]
+        in_file.close()
+        in_file = open(prefix + '0/' + metapath_name + '_idx.pickle', 'rb')
+        idx = pickle.load(in_file)
+        in_file.close()
+        MetapathCSR.from_adjlist(adjlist, idx, prefix + '0/' + metapath_name)
+        del adjlist, idx
+
+
+def load_HNEMA_metapath_csr(prefix, metapath_names=HNEMA_metapath_names, mmap_mode='r'):
+    # memory-map the binary metapath stores, the stores are generated from the legacy files first if they are missing
+    missing = [name for name in metapath_names if not MetapathCSR.exists(prefix + '0/' + name)]
+    if len(missing) > 0:
+        convert_HNEMA_metapath_to_csr(prefix, missing)
+    return [MetapathCSR.load(prefix + '0/' + name, mmap_mode) for name in metapath_names]
+
+
+def load_HNEMA_metapath_text(prefix):
     # read drug adjlist files using relative index
     # 也就是每个药物节点所对应的meta-path邻居的节点
     in_file = open(prefix + '0/0-1-0.adjlist', 'r')
@@ -43,6 +149,23 @@ def load_HNEMA_DDI_data_te(prefix='D:/B/PROJECT B2_2/dataset/generated_2/after_p
     idx03 = pickle.load(in_file)
     in_file.close()
 
+    return [[adjlist00, adjlist01, adjlist02, adjlist03], [adjlist00, adjlist01, adjlist02, adjlist03]], \
+           [[idx00, idx01, idx02, idx03], [idx00, idx01, idx02, idx03]]
+
+
+def load_HNEMA_DDI_data_te(prefix='D:/B/PROJECT B2_2/dataset/generated_2/after_process/', csr=False,
+                           sparse_se_labels=False):
+    print('the path of source file is :', prefix)
+
+    if csr:
+        # the binary CSR stores replace both the adjlists and the metapath indices
+        # parse_minibatch recognizes them and samples from the integer arrays directly
+        csr_list = load_HNEMA_metapath_csr(prefix)
+        adjlists = [csr_list, csr_list]
+        idx_lists = [csr_list, csr_list]
+    else:
+        adjlists, idx_lists = load_HNEMA_metapath_text(prefix)
+
     # 然后读取邻接矩阵，以及存储所有节点的类型的type_mask
     # read adjacency matrix storing the all required interactions required by training
     adjM = scipy.sparse.load_npz(prefix + 'adjM.npz')
@@ -67,14 +190,25 @@ def load_HNEMA_DDI_data_te(prefix='D:/B/PROJECT B2_2/dataset/generated_2/after_p
     in_file.close()
 
     # 再读取训练所需的样本以及标签
-    train_val_test_drug_drug_samples = np.load(prefix + 'train_val_test_drug_drug_samples.npz')
-    train_val_test_drug_drug_labels = np.load(prefix + 'train_val_test_drug_drug_labels.npz')
+    # the archives are read completely (not kept as lazy NpzFile objects): the forked workers of HNEMA_sweep.py
+    # would otherwise share one zip file descriptor and its offset, and their concurrent reads would race
+    train_val_test_drug_drug_samples = dict(np.load(prefix + 'train_val_test_drug_drug_samples.npz'))
+    train_val_test_drug_drug_labels = dict(np.load(prefix + 'train_val_test_drug_drug_labels.npz'))
+    # the side effect labels are either dense arrays in train_val_test_drug_drug_labels.npz or sparse
+    # <phase>_se_labels.npz files (HNEMA_dataset_builder.py), sparse_se_labels: keep them as csr matrices
+    for phase in ['train', 'val', 'test']:
+        if phase + '_se_labels' not in train_val_test_drug_drug_labels:
+            se_labels = scipy.sparse.load_npz(prefix + phase + '_se_labels.npz').tocsr()
+            train_val_test_drug_drug_labels[phase + '_se_labels'] = \
+                se_labels if sparse_se_labels else se_labels.toarray().astype('float32')
+        elif sparse_se_labels:
+            train_val_test_drug_drug_labels[phase + '_se_labels'] = \
+                scipy.sparse.csr_matrix(train_val_test_drug_drug_labels[phase + '_se_labels'])
     # 药物morgan信息
     all_drug_morgan = scipy.sparse.load_npz(prefix + 'ECFP6_DNN_coomatrix.npz')
 
     # 药物的metapath邻居，每个药物的metapath，邻接矩阵，节点类型，节点name2id，训练样本以及标签
-    return [[adjlist00, adjlist01, adjlist02, adjlist03],[adjlist00, adjlist01, adjlist02, adjlist03]], \
-           [[idx00, idx01, idx02, idx03],[idx00, idx01, idx02, idx03]], \
+    return adjlists, idx_lists, \
            adjM, type_mask, \
            [drug2id_dict,target2id_dict,cellline2id_dict,se_symbol2id_dict,atomnum2id_dict], \
            train_val_test_drug_drug_samples, train_val_test_drug_drug_labels, all_drug_morgan
@@ -1,10 +1,25 @@
+import os
+import threading
 import numpy as np
 import torch
 
 
+def state_dict_to_cpu(state):
+    # copy of a (nested) state dict on the cpu, the training can go on updating the parameters while it is saved
+    if isinstance(state, torch.Tensor):
+        return state.detach().to('cpu', copy=True)
+    if isinstance(state, dict):
+        return type(state)((key, state_dict_to_cpu(value)) for key, value in state.items())
+    if isinstance(state, (list, tuple)):
+        return type(state)(state_dict_to_cpu(value) for value in state)
+    return state
+
+
 class EarlyStopping:
     # early stoppong function that stops the model training in advance according to the specified loss
-    def __init__(self, patience, verbose=False, delta=0, save_path='checkpoint.pt'):
+    # async_save: the checkpoint is a cpu snapshot written by a background thread (call wait() before loading it)
+    # keep_top_k: the previous k-1 best checkpoints are kept as save_path_top2, ..., save_path_topk
+    def __init__(self, patience, verbose=False, delta=0, save_path='checkpoint.pt', async_save=False, keep_top_k=1):
 
         self.patience = patience
         self.verbose = verbose
@@ -14,6 +29,10 @@ class EarlyStopping:
         self.val_loss_min = np.Inf
         self.delta = delta
         self.save_path = save_path
+        self.async_save = async_save
+        self.keep_top_k = keep_top_k
+        self.save_thread = None
+        self.save_error = None
 
     def __call__(self, val_loss, model):
 
@@ -37,6 +56,47 @@ class EarlyStopping:
         if self.verbose:
             print(f'The corresponding loss decreases from {self.val_loss_min:.6f} to {val_loss:.6f}.  Saving model to', self.save_path)
 
-        torch.save(model, self.save_path)
+        # save_path=None: only keep track of the loss (e.g., the distributed ranks other than 0)
+        if self.save_path is not None:
+            if self.async_save:
+                # at most one checkpoint is written at a time, so the files are replaced in order
+                self.wait()
+                snapshot = state_dict_to_cpu(model)
+                self.save_thread = threading.Thread(target=self.write_checkpoint, args=(snapshot,), daemon=True)
+                self.save_thread.start()
+            else:
+                self.write_checkpoint(model)
         # torch.save(model.state_dict(), self.save_path)
         self.val_loss_min = val_loss
+
+    def top_k_path(self, k):
+        root, ext = os.path.splitext(self.save_path)
+        return '{}_top{}{}'.format(root, k, ext)
+
+    def write_checkpoint(self, model):
+        try:
+            # written to a temporary file and renamed, so save_path is always a complete checkpoint
+            tmp_path = self.save_path + '.tmp'
+            torch.save(model, tmp_path)
+            if self.keep_top_k > 1 and os.path.exists(self.save_path):
+                for k in range(self.keep_top_k, 2, -1):
+                    if os.path.exists(self.top_k_path(k - 1)):
+                        os.replace(self.top_k_path(k - 1), self.top_k_path(k))
+                os.replace(self.save_path, self.top_k_path(2))
+            os.replace(tmp_path, self.save_path)
+        except Exception as e:
+            if not self.async_save:
+                raise
+            self.save_error = e
+
+    def wait(self):
+        # blocks until the last checkpoint is on the disk
+        if self.save_thread is not None:
+            self.save_thread.join()
+            self.save_thread = None
+        if self.save_error is not None:
+            error, self.save_error = self.save_error, None
+            raise RuntimeError('the checkpoint could not be saved to {}'.format(self.save_path)) from error
+
+    def close(self):
+        self.wait()
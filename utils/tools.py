@@ -1,81 +1,151 @@
+import collections
+from concurrent.futures import ThreadPoolExecutor
 import torch
 import dgl
 import numpy as np
+import scipy.sparse
+from utils.data import MetapathCSR
 
-def parse_adjlist(adjlist, edge_metapath_indices, samples=None, exclude=None, offset=None, mode=None):
-    edges = []
-    nodes = set()
-    result_indices = []
-
-    for row, indices in zip(adjlist, edge_metapath_indices):
-        row_parsed = list(map(int, row.split(' ')))
-        nodes.add(row_parsed[0])
-        # 如果存在metapath邻居
-        if len(row_parsed) > 1:
-            # sampling neighbors
-            if samples is None:
-                if exclude is not None:
-                    if mode == 0:
-                        mask = [False if [u1, a1 - offset] in exclude or [u2, a2 - offset] in exclude else True for
-                                u1, a1, u2, a2 in indices[:, [0, 1, -1, -2]]]
-                    else:
-                        mask = [False if [u1, a1 - offset] in exclude or [u2, a2 - offset] in exclude else True for
-                                a1, u1, a2, u2 in indices[:, [0, 1, -1, -2]]]
-                    neighbors = np.array(row_parsed[1:])[mask]
-                    result_indices.append(indices[mask])
-                else:
-                    neighbors = row_parsed[1:]
-                    result_indices.append(indices)
-            else:
-                # undersampling frequent neighbors
-                # unique是去重后的结果（排序后）,counts是根据排序给定每个元素的出现次数
-                unique, counts = np.unique(row_parsed[1:], return_counts=True)
-                p = []
-                for count in counts:
-                    p += [(count ** (3 / 4)) / count] * count
-                p = np.array(p)
-                p = p / p.sum()
-                # p： 给出每个元素的出现概率(按照row parsed排序后的元素顺序给出）
-                samples = min(samples, len(row_parsed) - 1)
-                # replace=False每个值只能被选择一次，这里p是为了确定其中元素的出现概率,此时row_parse中的元素也是排序的，可以与sampled idx一一对应
-                sampled_idx = np.sort(np.random.choice(len(row_parsed) - 1, samples, replace=False, p=p))
-                # 若使用use_mask(这也是唯一区别): exclude=drug_target_batch，也就是当前batch中的药物对
-                if exclude is not None:
-                    if mode == 0:
-                        mask = [False if [u1, a1 - offset] in exclude or [u2, a2 - offset] in exclude else True for
-                                u1, a1, u2, a2 in indices[sampled_idx][:, [0, 1, -1, -2]]]
-                    else:
-                        mask = [False if [u1, a1 - offset] in exclude or [u2, a2 - offset] in exclude else True for
-                                a1, u1, a2, u2 in indices[sampled_idx][:, [0, 1, -1, -2]]]
-                    # sampled_idx是从row_parse的第一个元素开始选起的，而不是第0个
-                    neighbors = np.array([row_parsed[i + 1] for i in sampled_idx])[mask]
-                    result_indices.append(indices[sampled_idx][mask])
-                else:
-                    neighbors = [row_parsed[i + 1] for i in sampled_idx]
-                    result_indices.append(indices[sampled_idx])
-
-        # for the case that a node does not have any neighbors
-        else:
-            neighbors = [row_parsed[0]]
-            indices = np.array([[row_parsed[0]] * indices.shape[1]])
-            if mode == 1:
-                indices += offset
-            result_indices.append(indices)
+def pack_pair_keys(first, second):
+    # pack node pairs into int64 keys (node indices are far below 2 ** 31, and may be negative after removing the offset)
+    return (np.asarray(first, dtype=np.int64) << 32) + np.asarray(second, dtype=np.int64)
+
+
+def exclusion_mask(indices, exclude, offset, mode):
+    # mask the metapath instances whose endpoint pairs occur in exclude (the drug pairs of the current batch)
+    # the batch pairs are packed into int64 keys once and all instance endpoints are checked with a single np.isin
+    exclude = np.asarray(exclude, dtype=np.int64).reshape(-1, 2)
+    exclude_keys = np.unique(pack_pair_keys(exclude[:, 0], exclude[:, 1]))
+    if mode == 0:
+        u1, a1, u2, a2 = indices[:, 0], indices[:, 1], indices[:, -1], indices[:, -2]
+    else:
+        a1, u1, a2, u2 = indices[:, 0], indices[:, 1], indices[:, -1], indices[:, -2]
+    excluded = np.isin(pack_pair_keys(u1, a1 - offset), exclude_keys) | \
+               np.isin(pack_pair_keys(u2, a2 - offset), exclude_keys)
+    return ~excluded
+
+
+def sample_metapath_csr(csr, rows, samples=None, rng=None):
+    # batched metapath neighbor sampling over a MetapathCSR store
+    # returns, for every sampled instance, the position of its row in rows and its index in csr.neighbors/csr.instances
+    # (ordered by row position first and by the original instance order second)
+    # frequent neighbors are undersampled: each instance is drawn with probability ~ count ** (3 / 4) / count,
+    # where count is the number of instances of its row sharing the same neighbor
+    rng = np.random if rng is None else rng
+    rows = np.asarray(rows, dtype=np.int64)
+    starts = csr.offsets[rows]
+    degrees = csr.offsets[rows + 1] - starts
+    total = int(degrees.sum())
+    seg = np.repeat(np.arange(len(rows)), degrees)
+    seg_starts = np.cumsum(degrees) - degrees
+    inst_idx = np.repeat(starts, degrees) + (np.arange(total) - np.repeat(seg_starts, degrees))
+    if samples is None or total == 0:
+        return seg, inst_idx
 
-        for dst in neighbors:
-            nodes.add(dst)
-            edges.append((row_parsed[0], dst))
+    # the number of instances sharing the same (row, neighbor) pair
+    neighbors = np.asarray(csr.neighbors[inst_idx])
+    order = np.lexsort((neighbors, seg))
+    sorted_seg, sorted_neighbors = seg[order], neighbors[order]
+    new_group = np.ones(total, dtype=bool)
+    new_group[1:] = (sorted_seg[1:] != sorted_seg[:-1]) | (sorted_neighbors[1:] != sorted_neighbors[:-1])
+    group_id = np.cumsum(new_group) - 1
+    counts = np.empty(total, dtype=np.float64)
+    counts[order] = np.bincount(group_id)[group_id]
+    weights = counts ** (3 / 4) / counts
 
-    mapping = {map_from: map_to for map_to, map_from in enumerate(sorted(nodes))}
+    # weighted sampling without replacement for all rows at once (Efraimidis-Spirakis exponential keys):
+    # keeping the min(samples, degree) smallest keys of each row follows the same distribution as
+    # np.random.choice(degree, samples, replace=False, p=weights / weights.sum()) row by row
+    keys = rng.exponential(size=total) / weights
+    order = np.lexsort((keys, seg))
+    rank = np.arange(total) - np.repeat(seg_starts, degrees)
+    keep = rank < np.repeat(np.minimum(degrees, samples), degrees)
+    selected = np.sort(order[keep])
+    return seg[selected], inst_idx[selected]
+
+
+def parse_metapath_rows(csr, rows, centers, samples=None, exclude=None, offset=None, mode=None, rng=None):
+    # sample the metapath instances of rows in csr and assemble the edges of the batch subgraph
+    # centers: the central node (relative index) of every row
+    centers = np.asarray(centers, dtype=np.int64)
+    seg, inst_idx = sample_metapath_csr(csr, rows, samples, rng)
+    neighbors = np.asarray(csr.neighbors[inst_idx], dtype=np.int64)
+    indices = np.asarray(csr.instances[inst_idx], dtype=np.int64).reshape(-1, csr.metapath_len)
+
+    # 若使用use_mask(这也是唯一区别): exclude=drug_target_batch，也就是当前batch中的药物对
+    if exclude is not None:
+        mask = exclusion_mask(indices, exclude, offset, mode)
+        seg, neighbors, indices = seg[mask], neighbors[mask], indices[mask]
+
+    # for the case that a node does not have any neighbors
+    empty = np.flatnonzero(csr.degrees(rows) == 0)
+    if len(empty) > 0:
+        empty_indices = np.repeat(centers[empty][:, None], indices.shape[1], axis=1)
+        if mode == 1:
+            empty_indices += offset
+        seg = np.concatenate([seg, empty])
+        neighbors = np.concatenate([neighbors, centers[empty]])
+        indices = np.concatenate([indices, empty_indices])
+        order = np.argsort(seg, kind='stable')
+        seg, neighbors, indices = seg[order], neighbors[order], indices[order]
+
+    # relabel the nodes of the subgraph by their sorted order
+    # mapping: the sorted (relative) node indices, i.e. node mapping[i] is relabeled as i
+    # edges: E x 2 array of the relabeled (central node, neighbor) pairs
+    num_edges = len(seg)
+    mapping, inverse = np.unique(np.concatenate([centers[seg], neighbors, centers]), return_inverse=True)
     # 根据该映射将edges也用batch index进行映射
-    edges = list(map(lambda tup: (mapping[tup[0]], mapping[tup[1]]), edges))
-    result_indices = np.vstack(result_indices)
+    edges = np.stack([inverse[:num_edges], inverse[num_edges:2 * num_edges]], axis=1)
+
+    return edges, indices, len(mapping), mapping
 
-    return edges, result_indices, len(nodes), mapping
+
+def parse_adjlist(adjlist, edge_metapath_indices, samples=None, exclude=None, offset=None, mode=None, rng=None):
+    # adjlist: the .adjlist lines of the batch rows, edge_metapath_indices: the corresponding metapath instances
+    # the rows are gathered into a batch-local MetapathCSR and sampled together
+    rows_parsed = [np.array(row.split(' '), dtype=np.int64) for row in adjlist]
+    degrees = np.array([len(row_parsed) - 1 for row_parsed in rows_parsed], dtype=np.int64)
+    offsets = np.zeros(len(rows_parsed) + 1, dtype=np.int64)
+    np.cumsum(degrees, out=offsets[1:])
+    batch_csr = MetapathCSR(offsets,
+                            np.concatenate([row_parsed[1:] for row_parsed in rows_parsed]),
+                            np.vstack(edge_metapath_indices))
+    centers = [row_parsed[0] for row_parsed in rows_parsed]
+    return parse_metapath_rows(batch_csr, np.arange(len(rows_parsed)), centers, samples, exclude, offset, mode, rng)
+
+
+def parse_adjlist_csr(csr, rows, samples=None, exclude=None, offset=None, mode=None, rng=None):
+    # the same as parse_adjlist, but works on the integer arrays of a MetapathCSR store
+    # rows: the central nodes (relative index) of the current batch
+    return parse_metapath_rows(csr, rows, rows, samples, exclude, offset, mode, rng)
+
+
+def parse_metapath_graph(adjlist, indices, rows, device, samples=None, exclude=None, offset=None, mode=None, rng=None):
+    # build the subgraph of one metapath for the central nodes rows
+    if isinstance(adjlist, MetapathCSR):
+        # binary CSR store (the metapath instances are also stored in it)
+        edges, result_indices, num_nodes, mapping = parse_adjlist_csr(adjlist, rows, samples, exclude, offset, mode, rng)
+    else:
+        # 处理药物对中前面或者后面节点的metapath子图
+        edges, result_indices, num_nodes, mapping = parse_adjlist(
+            [adjlist[row] for row in rows], [indices[row] for row in rows], samples, exclude, offset, mode, rng)
+
+    # Multigraph means that there can be multiple edges between two nodes.
+    # Multigraphs are graphs that can have multiple (directed) edges between the same pair of nodes, including self loops. For instance, two authors can coauthor a paper in different years, resulting in edges with different features.
+    # the edges are ordered by (central node, neighbor) with a stable lexsort, and point from the neighbor to the central node
+    # result_indices是整理好顺序的该batch所对应metapath样本，可能有重复，使用绝对标签,同时其顺序与g.edges()顺序一致（由sorted_index确定）
+    sorted_index = np.lexsort((edges[:, 1], edges[:, 0]))
+    src = torch.from_numpy(edges[sorted_index, 1])
+    dst = torch.from_numpy(edges[sorted_index, 0])
+    # the graph is built directly on the target device, together with result_indices
+    g = dgl.graph((src, dst), num_nodes=num_nodes, device=device)
+    result_indices = torch.from_numpy(np.ascontiguousarray(result_indices[sorted_index])).to(device)
+
+    return g, result_indices, np.searchsorted(mapping, rows)
 
 
 def parse_minibatch(adjlists_ua, edge_metapath_indices_list_ua, drug_target_batch, device, samples=None,
-                        use_masks=None, offset=None):
+                        use_masks=None, offset=None, rng=None):
     # 第一个参数是每个药物节点的metapath邻居
     # 第二个参数是以相对index存储的metapath样本信息[
     # 第三个参数是当前batch中样本对的节点序号
@@ -88,46 +158,90 @@ def parse_minibatch(adjlists_ua, edge_metapath_indices_list_ua, drug_target_batc
         # the loop for iterating every metapath of one type of node
         # the order of adjlist and indices are the same
         # indices包含metapath样本的list
+        rows = [row[mode] for row in drug_target_batch]
         for adjlist, indices, use_mask in zip(adjlists, edge_metapath_indices_list, use_masks[mode]):
-            if use_mask:
-                # 处理药物对中前面或者后面节点的metapath子图
-                # samples=100
-                edges, result_indices, num_nodes, mapping = parse_adjlist(
-                    [adjlist[row[mode]] for row in drug_target_batch],
-                    [indices[row[mode]] for row in drug_target_batch], samples, drug_target_batch, offset, mode)
+            g, result_indices, idx_batch_mapped = parse_metapath_graph(
+                adjlist, indices, rows, device, samples, drug_target_batch if use_mask else None, offset, mode, rng)
 
-            else:
-                edges, result_indices, num_nodes, mapping = parse_adjlist(
-                    [adjlist[row[mode]] for row in drug_target_batch],
-                    [indices[row[mode]] for row in drug_target_batch], samples, offset=offset, mode=mode)
+            g_lists[mode].append(g)
+            result_indices_lists[mode].append(result_indices)
+            idx_batch_mapped_lists[mode].append(idx_batch_mapped)
 
-            # Multigraph means that there can be multiple edges between two nodes.
-            # Multigraphs are graphs that can have multiple (directed) edges between the same pair of nodes, including self loops. For instance, two authors can coauthor a paper in different years, resulting in edges with different features.
-            g = dgl.DGLGraph(multigraph=True)
-            g.add_nodes(num_nodes)
+    return g_lists, result_indices_lists, idx_batch_mapped_lists
 
-            if len(edges) > 0:
-                sorted_index = sorted(range(len(edges)), key=lambda i: edges[i])
-                g.add_edges(*list(zip(*[(edges[i][1], edges[i][0]) for i in sorted_index])))
 
-                # result_indices是整理好顺序的该batch所对应metapath样本，可能有重复，使用绝对标签,同时其顺序与g.edges()顺序一致（由sorted_index确定）
-                result_indices = torch.LongTensor(result_indices[sorted_index]).to(device)
+def parse_minibatch_unique(adjlists_ua, edge_metapath_indices_list_ua, drug_target_batch, device, samples=None,
+                           use_masks=None, offset=None, rng=None):
+    # the same as parse_minibatch, but every drug occurring in the batch (in either position) is parsed only once
+    # the subgraphs follow the conventions of the row drugs (mode 0), and batch_inverse (B x 2) maps both positions
+    # of every drug pair to the unique drugs, so that the drug embeddings can be computed once and gathered back
+    drug_drug_idx = np.asarray(drug_target_batch, dtype=np.int64)[:, :2]
+    unique_drugs, batch_inverse = np.unique(drug_drug_idx, return_inverse=True)
+    rows = unique_drugs.tolist()
 
-            else:
-                result_indices = torch.LongTensor(result_indices).to(device)
+    g_list, result_indices_list, idx_batch_mapped_list = [], [], []
+    for adjlist, indices, use_mask in zip(adjlists_ua[0], edge_metapath_indices_list_ua[0], use_masks[0]):
+        g, result_indices, idx_batch_mapped = parse_metapath_graph(
+            adjlist, indices, rows, device, samples, drug_target_batch if use_mask else None, offset, 0, rng)
+        g_list.append(g)
+        result_indices_list.append(result_indices)
+        idx_batch_mapped_list.append(idx_batch_mapped)
 
-            g_lists[mode].append(g)
-            result_indices_lists[mode].append(result_indices)
-            idx_batch_mapped_lists[mode].append(np.array([mapping[row[mode]] for row in drug_target_batch]))
+    batch_inverse = torch.LongTensor(batch_inverse.reshape(drug_drug_idx.shape)).to(device)
+    return g_list, result_indices_list, idx_batch_mapped_list, batch_inverse
 
-    # print(g_lists,len(g_lists))
-    # print(result_indices_lists,len(result_indices_lists))
-    # print(idx_batch_mapped_lists,len(idx_batch_mapped_lists))
-    return g_lists, result_indices_lists, idx_batch_mapped_lists
+
+class metapath_subgraph_cache:
+    # deterministic metapath neighborhoods for evaluation
+    # the neighborhood of every node is sampled once with a fixed seed and stored as a per-node block (a MetapathCSR),
+    # then batch subgraphs are assembled by concatenating the cached blocks of the batch nodes
+    # the parsed minibatches are also memoized, so evaluating the same batches every epoch only costs model compute
+    def __init__(self, adjlists_ua, edge_metapath_indices_list_ua, num_nodes, samples=None, seed=0, offset=None):
+        rng = np.random.RandomState(seed)
+        self.offset = offset
+        self.blocks_ua = [[], []]
+        self.minibatches = {}
+        rows = np.arange(num_nodes)
+        for mode, (adjlists, edge_metapath_indices_list) in enumerate(zip(adjlists_ua, edge_metapath_indices_list_ua)):
+            for adjlist, indices in zip(adjlists, edge_metapath_indices_list):
+                if not isinstance(adjlist, MetapathCSR):
+                    adjlist = MetapathCSR.from_adjlist(adjlist, indices)
+                seg, inst_idx = sample_metapath_csr(adjlist, rows, samples, rng)
+                neighbors = np.asarray(adjlist.neighbors[inst_idx], dtype=np.int64)
+                instances = np.asarray(adjlist.instances[inst_idx], dtype=np.int64).reshape(-1, adjlist.metapath_len)
+
+                # the self-loop instance of nodes without any neighbors is stored in the block as well
+                empty = np.flatnonzero(adjlist.degrees(rows) == 0)
+                if len(empty) > 0:
+                    empty_instances = np.repeat(empty[:, None], adjlist.metapath_len, axis=1)
+                    if mode == 1:
+                        empty_instances += offset
+                    seg = np.concatenate([seg, empty])
+                    neighbors = np.concatenate([neighbors, empty])
+                    instances = np.concatenate([instances, empty_instances])
+                    order = np.argsort(seg, kind='stable')
+                    seg, neighbors, instances = seg[order], neighbors[order], instances[order]
+
+                block_offsets = np.zeros(num_nodes + 1, dtype=np.int64)
+                np.cumsum(np.bincount(seg, minlength=num_nodes), out=block_offsets[1:])
+                self.blocks_ua[mode].append(MetapathCSR(block_offsets, neighbors, instances))
+
+    def parse_minibatch(self, drug_target_batch, device, unique=False):
+        # the same outputs as parse_minibatch (or parse_minibatch_unique) with no_masks, built from the cached blocks
+        drug_target_batch_array = np.asarray(drug_target_batch, dtype=np.int64)
+        key = (unique, drug_target_batch_array.shape, drug_target_batch_array.tobytes())
+        if key not in self.minibatches:
+            no_masks = [[False] * len(blocks) for blocks in self.blocks_ua]
+            parse = parse_minibatch_unique if unique else parse_minibatch
+            self.minibatches[key] = parse(self.blocks_ua, self.blocks_ua, drug_target_batch, device,
+                                          None, no_masks, self.offset)
+        return self.minibatches[key]
 
 
 class index_generator:
-    def __init__(self, batch_size, num_data=None, indices=None, shuffle=True):
+    # rank/world_size: distributed training, every rank iterates over its own shard of the indices
+    # all ranks shuffle with the same seed, and the shards are padded to the same length so that every rank runs the same number of iterations
+    def __init__(self, batch_size, num_data=None, indices=None, shuffle=True, rank=0, world_size=1, seed=None):
         if num_data is not None:
             self.num_data = num_data
             self.indices = np.arange(num_data)
@@ -137,8 +251,20 @@ class index_generator:
         self.batch_size = batch_size
         self.iter_counter = 0
         self.shuffle = shuffle
+        self.rank = rank
+        self.world_size = world_size
+        self.rng = np.random if seed is None else np.random.RandomState(seed)
         if shuffle:
-            np.random.shuffle(self.indices)
+            self.rng.shuffle(self.indices)
+        if world_size > 1:
+            self.all_indices = self.indices
+            self.num_data = int(np.ceil(len(self.all_indices) / world_size))
+            self.indices = self.shard()
+
+    def shard(self):
+        # pad with the first indices, as torch's DistributedSampler does
+        padded = np.concatenate([self.all_indices, self.all_indices[:self.num_data * self.world_size - len(self.all_indices)]])
+        return padded[self.rank::self.world_size]
 
     def next(self):
         if self.num_iterations_left() <= 0:
@@ -154,5 +280,85 @@ class index_generator:
 
     def reset(self):
         if self.shuffle:
-            np.random.shuffle(self.indices)
-        self.iter_counter = 0
\ No newline at end of file
+            if self.world_size > 1:
+                self.rng.shuffle(self.all_indices)
+                self.indices = self.shard()
+            else:
+                self.rng.shuffle(self.indices)
+        self.iter_counter = 0
+
+
+class sparse_label_matrix:
+    # multi-label targets (e.g., the side effects) kept on the device as csr rows (indptr/indices of the positive classes),
+    # indexing with the sample indices of a batch returns the dense float32 targets of the batch only,
+    # so the resident memory scales with the number of positives instead of samples x classes
+    def __init__(self, labels, device):
+        labels = scipy.sparse.csr_matrix(labels)
+        labels.sum_duplicates()
+        labels.eliminate_zeros()
+        self.indptr = torch.as_tensor(labels.indptr, dtype=torch.int64).to(device)
+        self.indices = torch.as_tensor(labels.indices, dtype=torch.int64).to(device)
+        self.shape = labels.shape
+        self.device = device
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, rows):
+        # rows: a slice, a list/numpy array or a tensor (also on the device) of sample indices
+        if isinstance(rows, slice):
+            rows = range(*rows.indices(self.shape[0]))
+        if torch.is_tensor(rows):
+            rows = rows.to(device=self.device, dtype=torch.int64)
+        else:
+            rows = torch.as_tensor(np.asarray(rows), dtype=torch.int64).to(self.device)
+        starts = self.indptr[rows]
+        degrees = self.indptr[rows + 1] - starts
+        batch_rows = torch.repeat_interleave(torch.arange(len(rows), device=self.device), degrees)
+        positions = torch.arange(len(batch_rows), device=self.device) - \
+            torch.repeat_interleave(torch.cumsum(degrees, 0) - degrees, degrees) + starts[batch_rows]
+        dense = torch.zeros(len(rows), self.shape[1], dtype=torch.float32, device=self.device)
+        dense[batch_rows, self.indices[positions]] = 1
+        return dense
+
+
+def multilabel_targets(labels, device, sparse=False):
+    # the side effect labels (dense array or scipy sparse matrix) on the device,
+    # sparse: as a sparse_label_matrix densified per batch instead of a dense tensor
+    if sparse:
+        return sparse_label_matrix(labels, device)
+    if scipy.sparse.issparse(labels):
+        labels = labels.toarray()
+    return torch.tensor(labels, dtype=torch.float32).to(device)
+
+
+class minibatch_prefetcher:
+    # prepares the next minibatches in background threads while the model works on the current one
+    # prepare_fn(sample_idx_batch, rng) builds everything a training step needs (e.g., by calling parse_minibatch)
+    # the sample indices are drawn in the main thread and every batch gets its own RandomState seeded by
+    # seed + batch counter, so the prepared minibatches do not depend on the number of workers or on thread timing
+    def __init__(self, idx_generator, prepare_fn, num_workers=1, prefetch=2, seed=None):
+        self.idx_generator = idx_generator
+        self.prepare_fn = prepare_fn
+        self.prefetch = prefetch
+        self.seed = np.random.randint(2 ** 31 - 1) if seed is None else seed
+        self.counter = 0
+        self.executor = ThreadPoolExecutor(max_workers=num_workers)
+        self.queue = collections.deque()
+
+    def submit(self):
+        rng = np.random.RandomState((self.seed + self.counter) % (2 ** 32))
+        self.queue.append(self.executor.submit(self.prepare_fn, self.idx_generator.next(), rng))
+        self.counter += 1
+
+    def next(self):
+        # keep up to prefetch batches in flight besides the one being returned
+        while len(self.queue) < self.prefetch + 1:
+            self.submit()
+        return self.queue.popleft().result()
+
+    def close(self):
+        for future in self.queue:
+            future.cancel()
+        self.queue.clear()
+        self.executor.shutdown(wait=True)